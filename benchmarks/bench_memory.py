@@ -0,0 +1,59 @@
+"""
+Память на сообщение: список dict'ов (старый формат chat_messages) против ChatColumns.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_memory.py
+"""
+import gc
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_memory_"))
+
+import main  # noqa: E402
+
+SIZES = (10_000, 100_000)
+
+def make_records(n: int) -> list:
+    rnd = random.Random(n)
+    words = ["кот", "чай", "завтра", "созвон", "опять", "дедлайн", "пицца", "ну", "да", "ладно"]
+    ts = 1_700_000_000
+    records = []
+    for _ in range(n):
+        ts += rnd.randint(1, 120)
+        user = rnd.randint(1, 40)
+        records.append({
+            "username": f"user{user}",
+            "user_id": 100_000 + user,
+            "text": " ".join(rnd.choice(words) for _ in range(rnd.randint(1, 12))),
+            "ts": ts,
+            "type": rnd.choice(main._MSG_TYPES) if rnd.random() < 0.1 else "text",
+        })
+    return records
+
+def measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    obj = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del obj
+    return size
+
+def main_bench() -> None:
+    print(f"{'messages':>9} | {'dicts, MB':>9} | {'columns, MB':>11} | {'B/msg dicts':>11} | {'B/msg cols':>10} | {'ratio':>5}")
+    for n in SIZES:
+        dicts = measure(lambda: make_records(n))
+        cols = measure(lambda: main.ChatColumns.from_records(make_records(n)))
+        print(
+            f"{n:>9} | {dicts / 2**20:>9.1f} | {cols / 2**20:>11.1f} | "
+            f"{dicts / n:>11.0f} | {cols / n:>10.0f} | {dicts / cols:>4.1f}x"
+        )
+
+if __name__ == "__main__":
+    main_bench()
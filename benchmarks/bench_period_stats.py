@@ -0,0 +1,65 @@
+"""
+Статистика за месяц по выгруженному чату: чтение снапшота "columns" через mmap
+против полной загрузки чата (load_chat) на синтетической истории в 1M сообщений.
+
+Каждый режим запускается в отдельном процессе; +RSS — прирост RSS (Linux, /proc/self/statm).
+
+Запуск из корня репозитория:
+    python benchmarks/bench_period_stats.py [число сообщений]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_period_stats_"))
+os.environ["SNAPSHOT_FORMAT"] = "columns"
+
+import main  # noqa: E402
+from bench_storage import make_columns  # noqa: E402
+
+CHAT_ID = "bench"
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+def run_mode(mode: str) -> None:
+    last_ts = main.chat_meta[CHAT_ID]["last_ts"]
+    period_start, period_end = main._month_range_for(datetime.fromtimestamp(last_ts, main.BOT_TZ))
+
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    if mode == "load":
+        main.chat_messages[CHAT_ID]
+    # Как хендлер /stats: проверка на пустоту + статистика за период
+    assert main.store.has_new_messages(CHAT_ID, 0)
+    stats = main.store.period_stats(CHAT_ID, 0, period_start, period_end)
+    elapsed = time.perf_counter() - started
+    assert (CHAT_ID in main.chat_messages) == (mode == "load")
+
+    print(f"{mode:>5} | {elapsed:>7.3f} | {rss_mb() - rss_before:>9.1f} | {stats['total']:>8}")
+
+def main_bench() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    cols = make_columns(n)
+    main._write_chat_snapshot(CHAT_ID, cols)
+    main._update_chat_meta(CHAT_ID, cols)
+    main.save_chat_meta()
+    del cols
+
+    print(f"{n} сообщений")
+    print(f"{'mode':>5} | {'time, s':>7} | {'+RSS, MB':>9} | {'in month':>8}")
+    for mode in ("mmap", "load"):
+        subprocess.run([sys.executable, __file__, "--mode", mode], check=True, env=os.environ)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--mode":
+        main.load_chat_meta()
+        run_mode(sys.argv[2])
+    else:
+        main_bench()
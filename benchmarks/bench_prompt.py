@@ -0,0 +1,65 @@
+"""
+Микробенчмарк сборки промпта сводки.
+
+Сравнивает старую сборку (raw += ... в цикле + большой f-string)
+с текущей generate_summary_prompt (join за один проход)
+на 1k / 10k / 100k сообщений.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_prompt.py
+"""
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_prompt_"))
+
+import main  # noqa: E402
+
+SIZES = (1_000, 10_000, 100_000)
+
+def legacy_generate_summary_prompt(messages: list) -> str:
+    raw = ""
+    for m in messages:
+        text = m.get("text", "")
+        if len(text) > main.MAX_TEXT_LENGTH_PER_MESSAGE:
+            text = text[:main.MAX_TEXT_LENGTH_PER_MESSAGE] + "..."
+        raw += f"{m.get('username', 'Аноним')}: {text}\n"
+
+    return f"""{main.SUMMARY_PROMPT_RULES}Вот сообщения чата:
+{raw}
+
+{main.SUMMARY_PROMPT_FINAL}"""
+
+def make_messages(n: int) -> list:
+    rnd = random.Random(n)
+    words = ["кот", "чай", "завтра", "созвон", "опять", "дедлайн", "пицца", "ну", "да", "ладно"]
+    return [
+        {
+            "username": f"user{rnd.randint(1, 40)}",
+            "text": " ".join(rnd.choice(words) for _ in range(rnd.randint(3, 120))),
+            "type": "text",
+        }
+        for _ in range(n)
+    ]
+
+def bench(fn, repeat: int) -> float:
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1000
+
+def main_bench() -> None:
+    print(f"{'messages':>9} | {'legacy, ms':>11} | {'join, ms':>9} | {'speedup':>7}")
+    for n in SIZES:
+        messages = make_messages(n)
+        assert legacy_generate_summary_prompt(messages) == main.generate_summary_prompt(messages)
+
+        repeat = 5 if n < 100_000 else 3
+        legacy = bench(lambda: legacy_generate_summary_prompt(messages), repeat)
+        joined = bench(lambda: main.generate_summary_prompt(messages), repeat)
+        print(f"{n:>9} | {legacy:>11.1f} | {joined:>9.1f} | {legacy / joined:>6.2f}x")
+
+if __name__ == "__main__":
+    main_bench()
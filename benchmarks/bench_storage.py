@@ -0,0 +1,80 @@
+"""
+Снапшот чата в разных форматах (SNAPSHOT_FORMAT): время сохранения/загрузки и размер файла
+на синтетической истории в 1M сообщений.
+
+"json" — прежний формат (JSON с отступами), остальные — компактные.
+read — только чтение и разбор файла (read_snapshot_file),
+load — load_chat целиком: разбор, сборка ChatColumns, пересчёт месячных агрегатов.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_storage.py [число сообщений]
+"""
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_storage_"))
+
+import main  # noqa: E402
+
+FORMATS = ("json", "jsonl.gz", "columns")
+
+def make_columns(n: int) -> "main.ChatColumns":
+    rnd = random.Random(n)
+    words = ["кот", "чай", "завтра", "созвон", "опять", "дедлайн", "пицца", "ну", "да", "ладно"]
+    cols = main.ChatColumns()
+    ts = 1_700_000_000
+    for _ in range(n):
+        ts += rnd.randint(1, 120)
+        user = rnd.randint(1, 40)
+        cols.append({
+            "username": f"user{user}",
+            "user_id": 100_000 + user,
+            "text": " ".join(rnd.choice(words) for _ in range(rnd.randint(1, 12))),
+            "ts": ts,
+            "type": rnd.choice(main._MSG_TYPES) if rnd.random() < 0.1 else "text",
+        })
+    return cols
+
+def timed(fn):
+    gc.collect()
+    started = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - started
+
+def main_bench() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    cols = make_columns(n)
+    chat_id = "bench"
+
+    print(f"{n} сообщений")
+    print(f"{'format':>9} | {'save, s':>8} | {'read, s':>8} | {'load, s':>8} | {'size, MB':>8} | {'vs json':>7}")
+    baseline = None
+    for fmt in FORMATS:
+        main.SNAPSHOT_FORMAT = fmt
+        _, save_s = timed(lambda: main._write_chat_snapshot(chat_id, cols))
+        path = main._chat_snapshot_path(chat_id, fmt)
+        size = os.path.getsize(path)
+        _, read_s = timed(lambda: main.read_snapshot_file(path))
+        loaded, load_s = timed(lambda: main.load_chat(chat_id))
+        assert len(loaded) == n and loaded.text(n - 1) == cols.text(n - 1)
+        del loaded
+
+        if baseline is None:
+            baseline = size
+        print(
+            f"{fmt:>9} | {save_s:>8.2f} | {read_s:>8.2f} | {load_s:>8.2f} | "
+            f"{size / 2**20:>8.1f} | {baseline / size:>6.1f}x"
+        )
+
+        for suffix in ("", ".prev"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+if __name__ == "__main__":
+    main_bench()
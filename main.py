@@ -1,16 +1,41 @@
 from dotenv import load_dotenv
+import asyncio
+import bisect
 import os
 import json
 import traceback
+import hashlib
+import gzip
+import mmap
+import struct
+import sys
 import uuid
+import urllib.parse
 import socket
 import platform
+import sqlite3
+import threading
+import functools
+import heapq
+import itertools
+import random
+import contextvars
+import email.utils
+import time as _time
+from contextlib import contextmanager
 from datetime import datetime, time, timedelta
-from collections import defaultdict
-from typing import Optional, Dict, Any, Tuple
+from array import array
+from collections import Counter, defaultdict, OrderedDict
+from typing import Optional, Dict, Any, Tuple, Callable, Iterable, Iterator
 
+try:
+    import tiktoken  # точный подсчёт токенов (есть в requirements.txt)
+except ImportError:
+    tiktoken = None
+
+import httpx
 import pytz
-from openai import OpenAI, APIConnectionError
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
@@ -28,12 +53,76 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-# Если основная попытка упала — пробуем последние N сообщений
+# Максимум сообщений в одном фрагменте map-reduce сводки
 MAX_MESSAGES_FOR_ANALYSIS = 500
 
 # Сколько символов берём из каждого сообщения при формировании промта
 MAX_TEXT_LENGTH_PER_MESSAGE = 600
 
+# OpenAI: таймаут одного запроса (сек), таймаут соединения и размер пула соединений
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "90"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "10"))
+
+# OpenAI: повторы при временных ошибках (сеть, таймаут, 408/409/429/5xx).
+# Пауза — экспоненциальная с полным джиттером: random(0, min(MAX_DELAY, BASE_DELAY * 2^(попытка-1))),
+# но не меньше Retry-After из ответа. Все попытки одной сводки укладываются в SUMMARY_DEADLINE сек.
+OPENAI_RETRY_MAX_ATTEMPTS = int(os.getenv("OPENAI_RETRY_MAX_ATTEMPTS", "4"))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "1.0"))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", "30"))
+SUMMARY_DEADLINE = float(os.getenv("SUMMARY_DEADLINE", "240"))
+
+# Предохранитель OpenAI: после OPENAI_BREAKER_THRESHOLD ошибок соединения или 5xx подряд запросы
+# сразу завершаются NETWORK-ошибкой, не дожидаясь таймаута. Таймаут ответа ошибкой не считается. Фоновая проба раз в
+# OPENAI_BREAKER_COOLDOWN сек (с удвоением до OPENAI_BREAKER_MAX_COOLDOWN) проверяет, вернулся ли доступ.
+OPENAI_BREAKER_THRESHOLD = int(os.getenv("OPENAI_BREAKER_THRESHOLD", "5"))
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "30"))
+OPENAI_BREAKER_MAX_COOLDOWN = float(os.getenv("OPENAI_BREAKER_MAX_COOLDOWN", "600"))
+
+# Лимиты OpenAI на нашей стороне (token bucket): запросов и токенов в минуту.
+# Токены запроса оцениваются до отправки: промпт + max_tokens (как считает сам OpenAI),
+# после ответа неиспользованное возвращается в бюджет. /whatsnew обслуживается раньше автосводок.
+# 0 — без ограничения.
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))
+
+# Автосводка: сколько чатов обрабатываем параллельно и лимит времени на один чат (сек)
+AUTOSUMMARY_CONCURRENCY = int(os.getenv("AUTOSUMMARY_CONCURRENCY", "5"))
+AUTOSUMMARY_CHAT_TIMEOUT = float(os.getenv("AUTOSUMMARY_CHAT_TIMEOUT", "300"))
+
+# Очередь задач: /whatsnew, автосводка, скользящий конспект и месячная статистика идут через
+# общую очередь с приоритетами. AUTOSUMMARY_CONCURRENCY воркеров берут любые задачи
+# (сначала интерактивные), ещё JOB_INTERACTIVE_WORKERS — только /whatsnew,
+# чтобы в пик автосводок ручная сводка не ждала, пока освободится слот.
+JOB_INTERACTIVE_WORKERS = int(os.getenv("JOB_INTERACTIVE_WORKERS", "1"))
+
+# Модель для сводок
+SUMMARY_MODEL = "gpt-4o-mini"
+
+# Map-reduce: если промпт больше SUMMARY_PROMPT_TOKEN_BUDGET токенов, бэклог режется
+# на фрагменты по SUMMARY_CHUNK_TOKENS, фрагменты суммируются параллельно
+# (не больше SUMMARY_MAP_CONCURRENCY одновременно), а итог собирается по конспектам
+SUMMARY_PROMPT_TOKEN_BUDGET = int(os.getenv("SUMMARY_PROMPT_TOKEN_BUDGET", "60000"))
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "20000"))
+SUMMARY_MAP_CONCURRENCY = int(os.getenv("SUMMARY_MAP_CONCURRENCY", "4"))
+
+# Подсчёт токенов: "auto" (tiktoken, если установлен, иначе эвристика), "tiktoken", "heuristic".
+# Кодировка tiktoken грузится в фоне после старта (первый раз — скачивается в TIKTOKEN_CACHE_DIR,
+# по умолчанию DATA_DIR/tiktoken), до этого и без сети токены считаются эвристикой.
+TOKENIZER = os.getenv("TOKENIZER", "auto").strip().lower()
+
+# Скользящий конспект: фоновая задача раз в ROLLING_DIGEST_INTERVAL сек дописывает
+# конспект чата, если с прошлого обновления набралось ROLLING_DIGEST_EVERY сообщений.
+# /whatsnew и автосводка тогда шлют в модель конспект + короткий хвост, а не весь бэклог.
+ROLLING_DIGEST_ENABLED = os.getenv("ROLLING_DIGEST", "1").strip() not in ("0", "false", "no", "")
+ROLLING_DIGEST_EVERY = int(os.getenv("ROLLING_DIGEST_EVERY", "200"))
+ROLLING_DIGEST_INTERVAL = int(os.getenv("ROLLING_DIGEST_INTERVAL", "900"))
+
+# Аренда сводки чата: пока одна сводка чата готовится, вторая не запускается.
+# Внутри процесса второй запрос ждёт результат первого; между процессами/рестартами
+# действует файл аренды в LEASES_DIR. Брошенная аренда (процесс упал) протухает через SUMMARY_LEASE_TTL сек.
+SUMMARY_LEASE_TTL = int(os.getenv("SUMMARY_LEASE_TTL", "900"))
+
 # Таймзона (UTC+3)
 BOT_TZ = pytz.timezone("Europe/Moscow")
 
@@ -46,23 +135,285 @@ BOT_TZ = pytz.timezone("Europe/Moscow")
 DEFAULT_DATA_DIR = "/data" if os.path.isdir("/data") else os.path.join(os.getcwd(), "data")
 DATA_DIR = os.getenv("DATA_DIR", DEFAULT_DATA_DIR)
 os.makedirs(DATA_DIR, exist_ok=True)
+# Кэш кодировок tiktoken — рядом с данными, чтобы переживал рестарты (см. TOKENIZER)
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(DATA_DIR, "tiktoken"))
+
+# Бэкенд хранения истории (можно переопределить через .env: STORAGE_BACKEND=...)
+# - "json"   — по снапшоту + журналу на чат в CHATS_DIR, загруженные чаты в памяти
+# - "sqlite" — SQLITE_FILE (WAL), в памяти только индексы сводок
+# При первом запуске sqlite импортирует существующую JSON-историю.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").strip().lower()
 
+# Старый общий файл истории: при старте json-бэкенда разносится по CHATS_DIR
 HISTORY_FILE = os.path.join(DATA_DIR, "chat_history.json")
+CHATS_DIR = os.path.join(DATA_DIR, "chats")
+os.makedirs(CHATS_DIR, exist_ok=True)
 SUMMARY_INDEX_FILE = os.path.join(DATA_DIR, "summary_index.json")
 MONTHLY_STATS_SENT_FILE = os.path.join(DATA_DIR, "monthly_stats_sent.json")
+SUMMARY_DIGEST_FILE = os.path.join(DATA_DIR, "summary_digest.json")
 ERROR_LOG_FILE = os.path.join(DATA_DIR, "error_log.txt")
+JOURNAL_FILE = os.path.join(DATA_DIR, "chat_journal.jsonl")  # старый общий журнал
+SQLITE_FILE = os.path.join(DATA_DIR, "chat_history.sqlite3")
+# Метаданные чатов (число сообщений, время последнего) — чтобы не поднимать историю ради проверки
+CHAT_META_FILE = os.path.join(DATA_DIR, "chat_meta.json")
+# Пачки буфера записи, которые так и не удалось сбросить (см. WRITE_BEHIND_MAX_RETRIES)
+WRITE_BEHIND_FAILED_FILE = os.path.join(DATA_DIR, "write_behind_failed.jsonl")
+# Файлы аренды сводок (см. SUMMARY_LEASE_TTL)
+LEASES_DIR = os.path.join(DATA_DIR, "leases")
+os.makedirs(LEASES_DIR, exist_ok=True)
+
+# Журнал сообщений (append-only, одна JSON-строка на запись)
+# JOURNAL_FSYNC:
+# - "always"   — fsync после каждой записи (максимальная надёжность)
+# - "interval" — fsync не чаще, чем раз в JOURNAL_FSYNC_INTERVAL секунд
+# - "never"    — только flush, сброс на диск на усмотрение ОС
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "interval").strip().lower()
+JOURNAL_FSYNC_INTERVAL = float(os.getenv("JOURNAL_FSYNC_INTERVAL", "1.0"))
+# После скольких записей в журнале делаем полный снапшот истории и обнуляем журнал
+JOURNAL_COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "1000"))
+
+# Сколько сообщений (суммарно по всем чатам) держим в памяти (json-бэкенд).
+# Сверх лимита давно не использованные чаты выгружаются и при обращении поднимаются с диска снова.
+# ~100 байт на сообщение в колоночном формате: 1 000 000 сообщений ≈ 100 МБ.
+RESIDENT_MAX_MESSAGES = int(os.getenv("RESIDENT_MAX_MESSAGES", "1000000"))
+
+# Политика хранения: уже попавшие в сводку сообщения удаляются фоновой задачей.
+# Сообщение остаётся, если выполнено хотя бы одно:
+# - оно ещё не в сводке (позиция >= last_summary_index)
+# - оно среди последних RETENTION_KEEP_MESSAGES сообщений перед last_summary_index
+# - ему меньше RETENTION_KEEP_DAYS дней
+# Месячные агрегаты удалённых сообщений сохраняются — /stats и monthly_stats_job их не теряют.
+RETENTION_ENABLED = os.getenv("RETENTION", "1").strip() not in ("0", "false", "no", "")
+RETENTION_KEEP_DAYS = int(os.getenv("RETENTION_KEEP_DAYS", "62"))
+RETENTION_KEEP_MESSAGES = int(os.getenv("RETENTION_KEEP_MESSAGES", "1000"))
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", "21600"))
+
+# Как часто (сек) сворачивать журналы загруженных чатов в снапшоты (json)
+# или делать checkpoint WAL (sqlite). Восстановление после рестарта = снапшот + хвост журнала.
+SNAPSHOT_INTERVAL = int(os.getenv("SNAPSHOT_INTERVAL", "600"))
+# Формат снапшотов чатов (старые форматы читаются всегда, при следующем снапшоте чат переписывается в этот):
+# - "columns"  — <chat>.cols, бинарный: заголовок с длиной + колонки ChatColumns как есть (быстрее всего)
+# - "jsonl.gz" — <chat>.jsonl.gz, JSON-строки по сообщению, gzip
+# - "json"     — <chat>.json, JSON с отступами, как раньше (удобно читать глазами)
+SNAPSHOT_FORMAT = os.getenv("SNAPSHOT_FORMAT", "columns").strip().lower()
+
+# Отложенная запись (write-behind): хендлер только кладёт запись в буфер,
+# фоновая задача сбрасывает пачку на диск. Окно потери при падении процесса:
+# - не дольше WRITE_BEHIND_MAX_DELAY_MS миллисекунд
+# - не больше WRITE_BEHIND_MAX_PENDING записей
+# WRITE_BEHIND_MAX_DELAY_MS=0 — писать сразу, как раньше.
+WRITE_BEHIND_MAX_DELAY_MS = int(os.getenv("WRITE_BEHIND_MAX_DELAY_MS", "500"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "200"))
+# Сколько раз подряд пробуем сбросить пачку, прежде чем отложить её в WRITE_BEHIND_FAILED_FILE
+WRITE_BEHIND_MAX_RETRIES = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "5"))
 
 # -----------------------------------------
 # OPENAI
 # -----------------------------------------
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Асинхронный клиент: пока генерируется сводка, бот продолжает принимать сообщения и команды
+_openai_timeout = httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    timeout=_openai_timeout,
+    max_retries=0,  # повторы — свои, см. _chat_completion
+
+    http_client=httpx.AsyncClient(
+        timeout=_openai_timeout,
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+        ),
+    ),
+)
+
+# -----------------------------------------
+# ХРАНИЛИЩЕ: колоночный формат чата
+# Вместо списка dict'ов (несколько сотен байт служебных данных на сообщение):
+# - user_id, ts         — array('q')
+# - тип                 — array('B') с кодом из _MSG_TYPES
+# - имя                 — номер в таблице интернированных имён чата
+# - текст               — общий UTF-8 буфер + смещения
+# ts хранится неубывающим (бегущий максимум) — это и есть индекс времени для бинарного поиска.
+# base — абсолютная позиция первой строки: после удаления старых сообщений (политика хранения)
+# позиции в last_summary_index, конспектах и журнале остаются прежними.
+# -----------------------------------------
+_MSG_TYPES = ("text", "photo", "video", "voice", "document")
+_MSG_TYPE_CODES = {t: i for i, t in enumerate(_MSG_TYPES)}
+
+class ChatColumns:
+    __slots__ = ("base", "user_ids", "ts", "types", "name_ids", "names", "_name_codes", "text_data", "text_offsets")
+
+    def __init__(self):
+        self.base = 0
+        self.user_ids = array("q")
+        self.ts = array("q")
+        self.types = array("B")
+        self.name_ids = array("I")
+        self.names: list = []
+        self._name_codes: Dict[str, int] = {}
+        self.text_data = bytearray()
+        self.text_offsets = array("Q", [0])
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    @property
+    def end(self) -> int:
+        """
+        Абсолютная позиция после последнего сообщения (сколько сообщений было в чате всего).
+        """
+        return self.base + len(self)
+
+    def append(self, m: Dict[str, Any]) -> None:
+        # ts дописываем последним: len() считает только полностью записанные строки,
+        # поэтому фоновый сброс на диск не увидит "половину" сообщения
+        self.user_ids.append(int(m.get("user_id") or 0))
+        self.types.append(_MSG_TYPE_CODES.get(m.get("type", "text"), 0))
+
+        name = m.get("username", "Аноним")
+        code = self._name_codes.get(name)
+        if code is None:
+            code = self._name_codes[name] = len(self.names)
+            self.names.append(name)
+        self.name_ids.append(code)
+
+        self.text_data += (m.get("text") or "").encode("utf-8")
+        self.text_offsets.append(len(self.text_data))
+
+        ts = _msg_epoch(m)
+        prev = self.ts[-1] if self.ts else 0
+        self.ts.append(prev if ts is None or ts < prev else ts)
+
+    def username(self, i: int) -> str:
+        return self.names[self.name_ids[i]]
+
+    def msg_type(self, i: int) -> str:
+        return _MSG_TYPES[self.types[i]]
+
+    def text(self, i: int) -> str:
+        return self.text_data[self.text_offsets[i]:self.text_offsets[i + 1]].decode("utf-8")
+
+    def row(self, i: int) -> Dict[str, Any]:
+        return {
+            "username": self.username(i),
+            "user_id": self.user_ids[i],
+            "text": self.text(i),
+            "ts": self.ts[i],
+            "type": self.msg_type(i),
+        }
+
+    def rows(self, lo: int = 0, hi: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        n = len(self)
+        lo = max(lo, 0)
+        hi = n if hi is None else min(hi, n)
+        for i in range(lo, hi):
+            yield self.row(i)
+
+    def to_records(self) -> list:
+        return list(self.rows())
+
+    def tail(self, lo: int) -> "ChatColumns":
+        """
+        Копия без первых lo строк (срезы колонок, без разбора сообщений).
+        """
+        lo = min(max(lo, 0), len(self))
+        cols = ChatColumns()
+        cols.base = self.base + lo
+        cols.user_ids = self.user_ids[lo:]
+        cols.types = self.types[lo:]
+        cols.name_ids = self.name_ids[lo:]
+        cols.names = list(self.names)
+        cols._name_codes = dict(self._name_codes)
+        start = self.text_offsets[lo]
+        cols.text_data = self.text_data[start:]
+        cols.text_offsets = array("Q", (o - start for o in self.text_offsets[lo:]))
+        cols.ts = self.ts[lo:]
+        return cols
+
+    @classmethod
+    def from_records(cls, records: Iterable[Dict[str, Any]], base: int = 0) -> "ChatColumns":
+        cols = cls()
+        cols.base = base
+        for m in records:
+            cols.append(m)
+        return cols
 
 # -----------------------------------------
 # ХРАНИЛИЩЕ (в памяти)
 # -----------------------------------------
-chat_messages = defaultdict(list)          # chat_id -> list[message_data]
+class ChatShards(OrderedDict):
+    """
+    chat_id -> ChatColumns, LRU загруженных чатов.
+    Чат поднимается с диска при обращении chat_messages[chat_id];
+    .get() и "in" смотрят только на уже загруженные чаты и не двигают их в очереди.
+    Когда в памяти больше RESIDENT_MAX_MESSAGES сообщений, самые давние чаты выгружаются.
+    """
+    def __init__(self):
+        super().__init__()
+        self.resident_messages = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def __missing__(self, chat_id: str) -> ChatColumns:
+        # Снапшот из потока (snapshot, save_chat в flush_batch) подменяет файл и обнуляет журнал:
+        # без лока сброса можно прочитать старый снапшот и уже обнулённый журнал
+        with write_buffer.hold():
+            cols = dict.get(self, chat_id)  # пока ждали лок, чат мог подняться в другом потоке
+            if cols is None:
+                cols = load_chat(chat_id)
+                self[chat_id] = cols
+                self.loads += 1
+        self.evict(keep=chat_id)
+        return cols
+
+    def __getitem__(self, chat_id: str) -> ChatColumns:
+        cols = super().__getitem__(chat_id)
+        self.move_to_end(chat_id)
+        return cols
+
+    def __setitem__(self, chat_id: str, cols: ChatColumns) -> None:
+        old = dict.get(self, chat_id)
+        super().__setitem__(chat_id, cols)
+        self.resident_messages += len(cols) - (len(old) if old is not None else 0)
+
+    def __delitem__(self, chat_id: str) -> None:
+        self.resident_messages -= len(dict.__getitem__(self, chat_id))
+        super().__delitem__(chat_id)
+
+    def note_append(self) -> None:
+        self.resident_messages += 1
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        if len(self) <= 1 or self.resident_messages <= RESIDENT_MAX_MESSAGES:
+            return
+        # Чаты с записями, ещё не дошедшими до журнала, не выгружаем: повторная загрузка
+        # с диска их бы не увидела. Сбрасывать буфер здесь нельзя — это диск и fsync в хендлере.
+        # Пока идёт сброс (он же может сворачивать журнал в снапшот), не выгружаем и не ждём его:
+        # after_flush буфера записи вызовет evict снова
+        with write_buffer.hold(blocking=False) as held:
+            if not held:
+                return
+            busy = {keep} | {str(r.get("chat_id")) for r in write_buffer.pending_records()}
+            for chat_id in list(self.keys()):
+                if len(self) <= 1 or self.resident_messages <= RESIDENT_MAX_MESSAGES:
+                    break
+                if chat_id in busy:
+                    continue
+                del self[chat_id]
+                month_aggregates.pop(chat_id, None)
+                chat_archive.pop(chat_id, None)
+                _journal_close(chat_id)
+                self.evictions += 1
+
+chat_messages = ChatShards()               # chat_id -> ChatColumns
 last_summary_index = defaultdict(int)      # chat_id -> int
 monthly_stats_last_sent = defaultdict(str) # chat_id -> "YYYY-MM"
+# chat_id -> {"from": last_summary_index, "upto": int, "text": str} — конспект сообщений [from, upto)
+running_digest: Dict[str, Dict[str, Any]] = {}
+# chat_id -> {"count": int, "base": int, "last_ts": int} — есть и для выгруженных чатов
+chat_meta: Dict[str, Dict[str, int]] = {}
+# chat_id -> (YYYY-MM, username, type) -> count — агрегаты сообщений, удалённых политикой хранения
+chat_archive: Dict[str, Dict[Tuple[str, str, str], int]] = {}
 
 # -----------------------------------------
 # ФУТЕР
@@ -92,6 +443,32 @@ def _parse_ts(ts: str) -> datetime:
         dt = dt.astimezone(BOT_TZ)
     return dt
 
+def _msg_epoch(m: Dict[str, Any]) -> Optional[int]:
+    """
+    Время сообщения в epoch-секундах. Новые записи хранят его в "ts",
+    старые — ISO-строкой в "timestamp" (мигрируются при загрузке).
+    """
+    ts = m.get("ts")
+    if ts is not None:
+        return int(ts)
+    iso = m.get("timestamp")
+    if not iso:
+        return None
+    try:
+        return int(_parse_ts(iso).timestamp())
+    except Exception:
+        return None
+
+def _migrate_message(m: Dict[str, Any]) -> bool:
+    """
+    ISO "timestamp" -> epoch "ts". Возвращает True, если запись поменялась.
+    """
+    if "timestamp" not in m:
+        return False
+    m["ts"] = _msg_epoch(m)
+    del m["timestamp"]
+    return True
+
 def _month_range_for(dt: datetime) -> Tuple[datetime, datetime]:
     """
     Возвращает [start, end) для месяца dt в BOT_TZ
@@ -135,89 +512,1718 @@ def log_error(error_id: str, where: str, exc: Exception, extra: Optional[Dict[st
     except Exception as file_exc:
         print("Не удалось записать в error_log.txt:", repr(file_exc))
 
+# -----------------------------------------
+# ИСТОРИЯ: отслеживание внешних изменений файлов
+# Память — источник правды. Перечитываем диск, только если файл
+# поменял кто-то другой (mtime/размер не совпадают с нашей последней записью).
+# -----------------------------------------
+_disk_signatures: Dict[str, Optional[Tuple[int, int]]] = {}
+
+def _file_signature(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def _remember_disk_state(*paths: str) -> None:
+    for path in paths:
+        _disk_signatures[path] = _file_signature(path)
+
+def history_changed_on_disk() -> bool:
+    return any(
+        _file_signature(path) != _disk_signatures.get(path)
+        for path in (SUMMARY_INDEX_FILE, MONTHLY_STATS_SENT_FILE, SUMMARY_DIGEST_FILE)
+    )
+
+# -----------------------------------------
+# ФАЙЛЫ: атомарная запись снапшотов
+# Пишем во временный файл, fsync, rename поверх старого — файл на диске
+# всегда либо старый целиком, либо новый целиком. Первая строка — sha256 содержимого,
+# предыдущая версия остаётся рядом (*.prev): битый снапшот при загрузке не затрёт историю.
+# -----------------------------------------
+_SNAPSHOT_MAGIC = "#snapshot "
+
+def _json_default(o: Any) -> Any:
+    if isinstance(o, ChatColumns):
+        return o.to_records()
+    raise TypeError(f"{type(o).__name__} не сериализуется в JSON")
+
+def _dump_json(obj: Any, indent: Optional[int] = None) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, indent=indent, default=_json_default).encode("utf-8")
+
+def _load_json(payload: bytes) -> Any:
+    return json.loads(payload.decode("utf-8"))
+
+def _chat_records(messages: Any) -> Iterable[Dict[str, Any]]:
+    return messages.rows() if isinstance(messages, ChatColumns) else messages
+
+def _dump_jsonl_gz(obj: Dict[str, Any], indent: Optional[int] = None) -> bytes:
+    """
+    Снапшот чата: первая строка — {"base", "archive"}, дальше по строке на сообщение.
+    """
+    head = {"base": obj.get("base", 0), "archive": obj.get("archive") or {}}
+    lines = [json.dumps(head, ensure_ascii=False, separators=(",", ":"))]
+    lines.extend(json.dumps(m, ensure_ascii=False, separators=(",", ":")) for m in _chat_records(obj["messages"]))
+    return gzip.compress("\n".join(lines).encode("utf-8"), compresslevel=6)
+
+def _load_jsonl_gz(payload: bytes) -> Dict[str, Any]:
+    lines = gzip.decompress(payload).decode("utf-8").split("\n")
+    head = json.loads(lines[0])
+    head["messages"] = [json.loads(line) for line in lines[1:] if line]
+    return head
+
+_COLUMN_ARRAYS = ("user_ids", "ts", "types", "name_ids", "text_offsets")
+
+def _dump_columns(obj: Dict[str, Any], indent: Optional[int] = None) -> bytes:
+    """
+    Снапшот чата: uint32 длины заголовка, JSON-заголовок (base, archive, имена, длины колонок),
+    затем колонки ChatColumns байт в байт и текстовый буфер. Загрузка — frombytes, без разбора сообщений.
+    """
+    cols = obj["messages"]
+    if not isinstance(cols, ChatColumns):
+        cols = ChatColumns.from_records(cols, obj.get("base", 0))
+
+    # Сброс идёт в фоновом потоке, пока цикл событий дописывает сообщения в этот же ChatColumns.
+    # Фиксируем число строк один раз (ts пишется последним — все колонки уже не короче n)
+    # и режем каждую колонку по нему; имена копируем после n — они тоже дописываются раньше ts.
+    n = len(cols)
+    arrays = [getattr(cols, attr)[:n + 1 if attr == "text_offsets" else n] for attr in _COLUMN_ARRAYS]
+    text_data = bytes(cols.text_data[:cols.text_offsets[n]])
+    names = list(cols.names)
+    head = json.dumps(
+        {
+            "base": obj.get("base", cols.base),
+            "archive": obj.get("archive") or {},
+            "names": names,
+            "byteorder": sys.byteorder,
+            "columns": [[a.typecode, a.itemsize, len(a)] for a in arrays],
+            "text": len(text_data),
+        },
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+    return b"".join([struct.pack("<I", len(head)), head] + [a.tobytes() for a in arrays] + [text_data])
+
+def _load_columns(payload: bytes) -> Dict[str, Any]:
+    (head_len,) = struct.unpack_from("<I", payload, 0)
+    head = json.loads(payload[4:4 + head_len].decode("utf-8"))
+    view = memoryview(payload)
+    pos = 4 + head_len
+
+    cols = ChatColumns()
+    cols.base = int(head["base"])
+    cols.names = list(head["names"])
+    cols._name_codes = {name: i for i, name in enumerate(cols.names)}
+    for attr, (typecode, itemsize, length) in zip(_COLUMN_ARRAYS, head["columns"]):
+        arr = array(typecode)
+        if arr.itemsize != itemsize:
+            raise ValueError(f"колонка {attr}: размер элемента {itemsize}, на этой платформе {arr.itemsize}")
+        arr.frombytes(view[pos:pos + itemsize * length])
+        if head["byteorder"] != sys.byteorder:
+            arr.byteswap()
+        pos += itemsize * length
+        setattr(cols, attr, arr)
+    cols.text_data = bytearray(view[pos:pos + head["text"]])
+
+    n = len(cols.ts)
+    if not (len(cols.user_ids) == len(cols.types) == len(cols.name_ids) == n and len(cols.text_offsets) == n + 1):
+        raise ValueError("длины колонок не совпадают")
+    return {"base": cols.base, "archive": head["archive"], "messages": cols}
+
+# name -> (dumps(obj, indent) -> bytes, loads(bytes) -> obj)
+# "json" годится для любых файлов, остальные — только для снапшотов чатов {"base", "archive", "messages"}
+_snapshot_formats: Dict[str, Tuple[Callable[..., bytes], Callable[[bytes], Any]]] = {
+    "json": (_dump_json, _load_json),
+    "jsonl.gz": (_dump_jsonl_gz, _load_jsonl_gz),
+    "columns": (_dump_columns, _load_columns),
+}
+# name -> расширение файла снапшота чата. Читается любой формат по заголовку,
+# расширение — чтобы по имени файла было видно, что внутри
+_snapshot_suffixes: Dict[str, str] = {
+    "json": ".json",
+    "jsonl.gz": ".jsonl.gz",
+    "columns": ".cols",
+}
+
+def register_snapshot_format(
+    name: str,
+    dumps: Callable[..., bytes],
+    loads: Callable[[bytes], Any],
+    suffix: Optional[str] = None,
+) -> None:
+    """
+    Подключить свой формат снапшотов чатов (например, zstd). suffix по умолчанию — "." + name.
+    """
+    _snapshot_formats[name] = (dumps, loads)
+    _snapshot_suffixes[name] = suffix or "." + name
+
+def _fsync_dir(path: str) -> None:
+    try:
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def write_snapshot_file(path: str, obj: Any, indent: Optional[int] = None, fmt: str = "json") -> None:
+    if fmt not in _snapshot_formats:
+        print(f"Неизвестный формат снапшота {fmt!r}, пишем json")
+        fmt = "json"
+    payload = _snapshot_formats[fmt][0](obj, indent)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(f"{_SNAPSHOT_MAGIC}v2 format={fmt} sha256={hashlib.sha256(payload).hexdigest()}\n".encode("ascii"))
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+
+    # Если упадём между двумя rename, загрузка возьмёт *.prev (журнал ещё не обнулён)
+    if os.path.exists(path):
+        os.replace(path, path + ".prev")
+    os.replace(tmp, path)
+    _fsync_dir(path)
+    _remember_disk_state(path)
+
+def _parse_snapshot_header(header: bytes) -> Dict[str, str]:
+    return dict(
+        part.split("=", 1) for part in header.decode("ascii")[len(_SNAPSHOT_MAGIC):].split() if "=" in part
+    )
+
+def _read_checked(path: str) -> Any:
+    """
+    Заголовок: "#snapshot v2 format=<name> sha256=<hex>" (v1 — без format, всегда json).
+    Без заголовка — обычный JSON из версий до контрольных сумм.
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    if not raw.startswith(_SNAPSHOT_MAGIC.encode("ascii")):
+        return json.loads(raw.decode("utf-8"))
+
+    header, _, payload = raw.partition(b"\n")
+    fields = _parse_snapshot_header(header)
+    actual = hashlib.sha256(payload).hexdigest()
+    if actual != fields.get("sha256"):
+        raise ValueError(f"контрольная сумма не совпала ({actual[:12]} != {fields.get('sha256', '')[:12]})")
+
+    fmt = fields.get("format", "json")
+    if fmt not in _snapshot_formats:
+        raise ValueError(f"неизвестный формат снапшота {fmt!r}")
+    return _snapshot_formats[fmt][1](payload)
+
+def read_snapshot_file(path: str, default: Any = None) -> Any:
+    """
+    Читает файл, записанный write_snapshot_file (или старый обычный JSON).
+    Битый файл — пробуем *.prev. Нет ни того, ни другого — default.
+    Оба битые — исключение: лучше не стартовать, чем затереть историю пустой.
+    """
+    last_error: Optional[Exception] = None
+    for candidate in (path, path + ".prev"):
+        if not os.path.exists(candidate):
+            continue
+        try:
+            obj = _read_checked(candidate)
+        except Exception as e:
+            print(f"Снапшот {candidate} повреждён:", repr(e))
+            last_error = e
+            continue
+        if candidate != path:
+            print(f"Снапшот {path} восстановлен из {candidate}")
+        return obj
+
+    if last_error is not None:
+        raise last_error
+    return default
+
+
+# -----------------------------------------
+# ФАЙЛЫ: чтение снапшота "columns" через mmap
+# Для статистики за период выгруженного чата: бинарный поиск по колонке ts
+# прямо в файле и чтение только строк периода. Контрольная сумма здесь
+# не проверяется (это чтение всего файла) — её проверяет полная загрузка чата.
+# -----------------------------------------
+class _MappedColumn:
+    """
+    Колонка внутри mmap без копирования: len() и [i] — этого хватает для bisect.
+    """
+    __slots__ = ("_buf", "_offset", "_fmt", "itemsize", "_len")
+
+    def __init__(self, buf: mmap.mmap, offset: int, typecode: str, itemsize: int, length: int):
+        self._buf = buf
+        self._offset = offset
+        self._fmt = "=" + typecode
+        self.itemsize = itemsize
+        self._len = length
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, i: int) -> int:
+        if not 0 <= i < self._len:
+            raise IndexError(i)
+        return struct.unpack_from(self._fmt, self._buf, self._offset + i * self.itemsize)[0]
+
+    def slice(self, lo: int, hi: int) -> array:
+        """
+        Копия строк [lo, hi): читаются только страницы этого диапазона.
+        """
+        arr = array(self._fmt[1:])
+        lo, hi = max(lo, 0), min(hi, self._len)
+        if lo < hi:
+            arr.frombytes(self._buf[self._offset + lo * self.itemsize:self._offset + hi * self.itemsize])
+        return arr
+
+class ChatSegment:
+    def __init__(self, path: str):
+        self._fh = open(path, "rb")
+        try:
+            self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._fh.close()
+            raise
+        try:
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def _parse(self) -> None:
+        mm = self._mm
+        header_end = mm.find(b"\n")
+        if not mm[:header_end].startswith(_SNAPSHOT_MAGIC.encode("ascii")):
+            raise ValueError("снапшот без заголовка")
+        if _parse_snapshot_header(mm[:header_end]).get("format") != "columns":
+            raise ValueError("снапшот не в формате columns")
+
+        pos = header_end + 1
+        (head_len,) = struct.unpack_from("<I", mm, pos)
+        head = json.loads(mm[pos + 4:pos + 4 + head_len].decode("utf-8"))
+        if head["byteorder"] != sys.byteorder:
+            raise ValueError("снапшот записан с другим порядком байт")
+        pos += 4 + head_len
+
+        self.columns: Dict[str, _MappedColumn] = {}
+        for attr, (typecode, itemsize, length) in zip(_COLUMN_ARRAYS, head["columns"]):
+            self.columns[attr] = _MappedColumn(mm, pos, typecode, itemsize, length)
+            pos += itemsize * length
+
+        self.base = int(head["base"])
+        self.names = head["names"]
+        self.archive = head.get("archive") or {}
+        self.ts = self.columns["ts"]
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def close(self) -> None:
+        self._mm.close()
+        self._fh.close()
+
+    def __enter__(self) -> "ChatSegment":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
 # -----------------------------------------
 # ИСТОРИЯ: загрузка/сохранение
 # -----------------------------------------
 def load_monthly_stats_sent() -> None:
     try:
-        if os.path.exists(MONTHLY_STATS_SENT_FILE):
-            with open(MONTHLY_STATS_SENT_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            for chat_id, month_key in data.items():
-                monthly_stats_last_sent[chat_id] = str(month_key)
+        data = read_snapshot_file(MONTHLY_STATS_SENT_FILE, {})
+        for chat_id, month_key in data.items():
+            monthly_stats_last_sent[chat_id] = str(month_key)
     except Exception as e:
         print("Ошибка загрузки monthly_stats_sent:", repr(e))
 
 def save_monthly_stats_sent() -> None:
     try:
-        with open(MONTHLY_STATS_SENT_FILE, "w", encoding="utf-8") as f:
-            json.dump(dict(monthly_stats_last_sent), f, ensure_ascii=False, indent=2)
+        write_snapshot_file(MONTHLY_STATS_SENT_FILE, dict(monthly_stats_last_sent), indent=2)
     except Exception as e:
         print("Ошибка сохранения monthly_stats_sent:", repr(e))
 
-def load_history() -> None:
-    global chat_messages, last_summary_index
+def load_summary_digests() -> None:
     try:
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
+        data = read_snapshot_file(SUMMARY_DIGEST_FILE)
+        if data is not None:
+            running_digest.clear()
+            running_digest.update(data)
+    except Exception as e:
+        print("Ошибка загрузки summary_digest:", repr(e))
 
-            for chat_id, messages in data.items():
-                if chat_id in chat_messages and chat_messages[chat_id]:
-                    existing_ts = {m.get("timestamp") for m in chat_messages[chat_id]}
-                    for m in messages:
-                        if m.get("timestamp") not in existing_ts:
-                            chat_messages[chat_id].append(m)
-                else:
-                    chat_messages[chat_id] = messages.copy()
-
-        if os.path.exists(SUMMARY_INDEX_FILE):
-            with open(SUMMARY_INDEX_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            for chat_id, idx in data.items():
-                idx_int = int(idx)
-                if chat_id in last_summary_index:
-                    last_summary_index[chat_id] = max(last_summary_index[chat_id], idx_int)
-                else:
-                    last_summary_index[chat_id] = idx_int
+def save_summary_digests() -> None:
+    try:
+        write_snapshot_file(SUMMARY_DIGEST_FILE, running_digest, indent=2)
+    except Exception as e:
+        print("Ошибка сохранения summary_digest:", repr(e))
+
+# -----------------------------------------
+# ИСТОРИЯ: шарды по чатам
+# У каждого чата свои файлы в CHATS_DIR:
+# - <chat>.cols / .jsonl.gz / .json — снапшот сообщений (расширение по SNAPSHOT_FORMAT)
+# - <chat>.jsonl — журнал (append-only, одна JSON-строка на событие)
+# Запись/сводка/статистика одного чата трогают только его файлы.
+# Индексы сводок, monthly_stats и конспекты — маленькие общие файлы.
+# -----------------------------------------
+def _chat_file_key(chat_id: str) -> str:
+    # id чатов в Telegram — числа со знаком, но имя файла собираем безопасно в любом случае
+    return urllib.parse.quote(str(chat_id), safe="-_")
+
+def _chat_snapshot_path(chat_id: str, fmt: Optional[str] = None) -> str:
+    """
+    Снапшот чата в формате fmt. Без fmt — тот, что лежит на диске (после смены SNAPSHOT_FORMAT
+    до следующего снапшота это файл старого формата), а если снапшота нет — путь для SNAPSHOT_FORMAT.
+    """
+    key = _chat_file_key(chat_id)
+    if fmt is not None:
+        return os.path.join(CHATS_DIR, key + _snapshot_suffixes.get(fmt, ".json"))
+
+    found = None
+    for suffix in set(_snapshot_suffixes.values()):
+        path = os.path.join(CHATS_DIR, key + suffix)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        # Оба формата сразу — только если упали, не успев удалить старый: берём свежий
+        if found is None or mtime > found[0]:
+            found = (mtime, path)
+    return found[1] if found is not None else _chat_snapshot_path(chat_id, SNAPSHOT_FORMAT)
+
+def _chat_journal_path(chat_id: str) -> str:
+    return os.path.join(CHATS_DIR, _chat_file_key(chat_id) + ".jsonl")
+
+def stored_chat_ids() -> list:
+    """
+    Чаты, у которых есть файлы на диске (без загрузки самих историй).
+    """
+    ids = set()
+    try:
+        suffixes = tuple(set(_snapshot_suffixes.values())) + (".jsonl",)
+        for name in os.listdir(CHATS_DIR):
+            for suffix in suffixes:
+                if name.endswith(suffix):
+                    ids.add(urllib.parse.unquote(name[:-len(suffix)]))
+                    break
+    except OSError:
+        pass
+    return sorted(ids)
+
+def chat_changed_on_disk(chat_id: str) -> bool:
+    return any(
+        _file_signature(path) != _disk_signatures.get(path)
+        for path in (_chat_snapshot_path(chat_id), _chat_journal_path(chat_id))
+    )
+
+# -----------------------------------------
+# ЖУРНАЛ: дозапись по одной строке на событие (по файлу на чат)
+# -----------------------------------------
+_journal_fhs: Dict[str, Any] = {}                   # chat_id -> открытый файл журнала
+_journal_records: Dict[str, int] = defaultdict(int) # chat_id -> записей с последнего снапшота
+_journal_last_fsync = 0.0
+
+def _journal_write_many(records: list) -> None:
+    """
+    Дописывает пачку записей в журналы их чатов: один write/flush на чат
+    и не больше одного fsync на файл. Стоимость O(len(records)), не зависит от размера истории.
+    """
+    global _journal_last_fsync
+    if not records:
+        return
+
+    by_chat: Dict[str, list] = {}
+    for r in records:
+        by_chat.setdefault(str(r.get("chat_id")), []).append(r)
+
+    now = _time.monotonic()
+    do_fsync = JOURNAL_FSYNC == "always" or (
+        JOURNAL_FSYNC == "interval" and now - _journal_last_fsync >= JOURNAL_FSYNC_INTERVAL
+    )
+
+    for chat_id, chat_records in by_chat.items():
+        try:
+            fh = _journal_fhs.get(chat_id)
+            if fh is None:
+                fh = _journal_fhs[chat_id] = open(_chat_journal_path(chat_id), "a", encoding="utf-8")
+
+            fh.write("".join(
+                json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in chat_records
+            ))
+            fh.flush()
+            if do_fsync:
+                os.fsync(fh.fileno())
+            _journal_records[chat_id] += len(chat_records)
+            _remember_disk_state(_chat_journal_path(chat_id))
+        except Exception as e:
+            print(f"Ошибка записи в журнал чата {chat_id}:", repr(e))
+
+    if do_fsync:
+        _journal_last_fsync = now
+
+def _journal_close(chat_id: str) -> None:
+    fh = _journal_fhs.pop(chat_id, None)
+    if fh is not None:
+        try:
+            fh.close()
+        except Exception as e:
+            print(f"Ошибка закрытия журнала чата {chat_id}:", repr(e))
+
+def _journal_reset(chat_id: str) -> None:
+    """
+    Обнуляет журнал чата после того, как его содержимое попало в снапшот.
+    """
+    try:
+        fh = _journal_fhs.pop(chat_id, None)
+        if fh is not None:
+            fh.close()
+        path = _chat_journal_path(chat_id)
+        with open(path, "w", encoding="utf-8"):
+            pass
+        _journal_records[chat_id] = 0
+        _remember_disk_state(path)
+    except Exception as e:
+        print(f"Ошибка очистки журнала чата {chat_id}:", repr(e))
+
+def journal_message(chat_id: str, position: int, message_data: Dict[str, Any]) -> None:
+    write_buffer.put({"op": "msg", "chat_id": chat_id, "i": position, "m": message_data})
+
+def _replay_journal(
+    path: str,
+    history: Dict[str, list],
+    index: Dict[str, int],
+    bases: Optional[Dict[str, int]] = None,
+) -> int:
+    """
+    Накатывает журнал path поверх снапшота (history/index/bases меняются на месте).
+    Позиции "i" в журнале абсолютные: bases[chat_id] — позиция первого сообщения снапшота.
+    Битая последняя строка (обрыв записи при падении) пропускается.
+    Возвращает число прочитанных записей.
+    """
+    if not os.path.exists(path):
+        return 0
+
+    count = 0
+
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except Exception:
+                continue
+
+            chat_id = str(rec.get("chat_id"))
+            op = rec.get("op")
+            count += 1
+
+            if op == "msg":
+                messages = history.setdefault(chat_id, [])
+                # Если процесс упал между записью снапшота и очисткой журнала,
+                # сообщение с этой позицией уже есть в снапшоте
+                position = rec.get("i")
+                base = bases.get(chat_id, 0) if bases is not None else 0
+                if position is not None and position < base + len(messages):
+                    continue
+                messages.append(rec.get("m") or {})
+            elif op == "index":
+                # Старый общий журнал: индексы сводок писались туда же
+                index[chat_id] = int(rec.get("value", 0))
+            elif op == "clear":
+                history[chat_id] = []
+                if bases is not None:
+                    bases[chat_id] = 0
+
+    return count
+
+# -----------------------------------------
+# ИСТОРИЯ: загрузка/сохранение чатов
+# -----------------------------------------
+def _read_chat_shard(chat_id: str) -> Tuple[int, Dict[Tuple[str, str, str], int], Any]:
+    """
+    Снапшот чата + его журнал: (base, архивные агрегаты, сообщения).
+    Снапшот — {"base", "archive", "messages"}; ранние версии писали просто список сообщений.
+    Сообщения — список dict'ов или сразу ChatColumns (формат "columns"), журнал дописывается в них же.
+    Обновляет счётчик записей журнала этого чата.
+    """
+    history: Dict[str, Any] = {chat_id: []}
+    bases: Dict[str, int] = {chat_id: 0}
+    archive: Dict[Tuple[str, str, str], int] = {}
+
+    snapshot = read_snapshot_file(_chat_snapshot_path(chat_id))
+    if snapshot is not None:
+        if isinstance(snapshot, list):
+            history[chat_id] = snapshot
+        else:
+            history[chat_id] = snapshot.get("messages", [])
+            bases[chat_id] = int(snapshot.get("base", 0))
+            for month, rows in (snapshot.get("archive") or {}).items():
+                for u, t, c in rows:
+                    archive[(month, u, t)] = archive.get((month, u, t), 0) + int(c)
+
+    _journal_records[chat_id] = _replay_journal(_chat_journal_path(chat_id), history, {}, bases)
+    return bases[chat_id], archive, history.get(chat_id, [])
+
+def _read_legacy_history() -> Tuple[Dict[str, list], Dict[str, int]]:
+    """
+    Старый формат: один HISTORY_FILE на все чаты + общий JOURNAL_FILE.
+    """
+    data: Dict[str, list] = read_snapshot_file(HISTORY_FILE, {})
+
+    index_data: Dict[str, int] = {}
+    _replay_journal(JOURNAL_FILE, data, index_data)
+    return data, index_data
+
+def _read_summary_index() -> Dict[str, int]:
+    return {k: int(v) for k, v in read_snapshot_file(SUMMARY_INDEX_FILE, {}).items()}
+
+def _read_json_history() -> Tuple[Dict[str, list], Dict[str, int], Dict[str, int], Dict[str, Dict]]:
+    """
+    Вся JSON-история целиком (старый общий файл + шарды) — для импорта в sqlite.
+    Возвращает (сообщения, индексы сводок, base чатов, архивные агрегаты чатов).
+    """
+    data, legacy_index = _read_legacy_history()
+    bases: Dict[str, int] = {}
+    archives: Dict[str, Dict] = {}
+    for chat_id in stored_chat_ids():
+        bases[chat_id], archives[chat_id], messages = _read_chat_shard(chat_id)
+        data[chat_id] = list(_chat_records(messages))
+
+    index_data = _read_summary_index()
+    for chat_id, idx in legacy_index.items():
+        index_data.setdefault(chat_id, idx)
+    return data, index_data, bases, archives
+
+def migrate_legacy_history() -> int:
+    """
+    Разносит старый общий HISTORY_FILE (+ JOURNAL_FILE) по шардам чатов.
+    Старые файлы переименовываются в *.migrated. Возвращает число перенесённых чатов.
+    """
+    if not (os.path.exists(HISTORY_FILE) or os.path.exists(JOURNAL_FILE)):
+        return 0
+
+    data, legacy_index = _read_legacy_history()
+    index_data = _read_summary_index()
+    for chat_id, idx in legacy_index.items():
+        index_data[chat_id] = max(index_data.get(chat_id, 0), idx)
+
+    moved = 0
+    for chat_id, messages in data.items():
+        # Шард уже есть — значит, чат перенесли раньше, он свежее
+        if os.path.exists(_chat_snapshot_path(chat_id)) or os.path.exists(_chat_journal_path(chat_id)):
+            continue
+        _write_chat_snapshot(chat_id, messages)
+        moved += 1
+
+    write_snapshot_file(SUMMARY_INDEX_FILE, index_data, indent=2)
+
+    for path in (HISTORY_FILE, JOURNAL_FILE):
+        if os.path.exists(path):
+            os.replace(path, path + ".migrated")
+
+    print(f"История: {moved} чатов перенесено из {os.path.basename(HISTORY_FILE)} в {CHATS_DIR}")
+    return moved
+
+def _write_chat_snapshot(
+    chat_id: str,
+    records: Any,
+    base: int = 0,
+    archive: Optional[Dict[Tuple[str, str, str], int]] = None,
+) -> None:
+    months: Dict[str, list] = {}
+    for (month, u, t), c in sorted((archive or {}).items()):
+        months.setdefault(month, []).append([u, t, c])
+
+    path = _chat_snapshot_path(chat_id, SNAPSHOT_FORMAT)
+    write_snapshot_file(
+        path,
+        {"base": base, "archive": months, "messages": records},
+        indent=2,
+        fmt=SNAPSHOT_FORMAT,
+    )
+
+    # SNAPSHOT_FORMAT сменили: снапшот старого формата больше не нужен
+    for suffix in set(_snapshot_suffixes.values()):
+        old = os.path.join(CHATS_DIR, _chat_file_key(chat_id) + suffix)
+        if old == path:
+            continue
+        for stale in (old, old + ".prev"):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+
+def load_chat(chat_id: str) -> ChatColumns:
+    """
+    Поднимает историю одного чата с диска (при первом обращении к чату).
+    Старые записи с ISO timestamp переводятся на epoch ts и сразу пересохраняются.
+    """
+    try:
+        base, archive, messages = _read_chat_shard(chat_id)
+    except Exception as e:
+        # Снапшот и *.prev битые: откладываем файлы в сторону, чтобы следующий снапшот их не затёр
+        suffix = f".corrupt-{int(_time.time())}"
+        snapshot_path = _chat_snapshot_path(chat_id)
+        for path in (snapshot_path, snapshot_path + ".prev", _chat_journal_path(chat_id)):
+            if os.path.exists(path):
+                os.replace(path, path + suffix)
+        log_error(uuid.uuid4().hex[:8], "load_chat", e, {"chat_id": chat_id, "moved_to": "*" + suffix})
+        base, archive, messages = 0, {}, []
+
+    if isinstance(messages, ChatColumns):
+        migrated = 0
+        cols = messages
+    else:
+        migrated = sum(1 for m in messages if _migrate_message(m))
+        cols = ChatColumns.from_records(messages, base)
+    if archive:
+        chat_archive[chat_id] = archive
+    else:
+        chat_archive.pop(chat_id, None)
+    _remember_disk_state(_chat_snapshot_path(chat_id), _chat_journal_path(chat_id))
+    _update_chat_meta(chat_id, cols)
+
+    rebuild_month_aggregates(chat_id, cols)
+    if migrated:
+        print(f"История чата {chat_id}: {migrated} записей переведено на epoch ts, сохраняем снапшот")
+        save_chat(chat_id, cols)
+    return cols
+
+def save_chat(chat_id: str, cols: Optional[ChatColumns] = None) -> None:
+    """
+    Снапшот одного чата. После успешной записи его журнал обнуляется.
+    """
+    if cols is None:
+        cols = dict.get(chat_messages, chat_id)
+        if cols is None:
+            return
+    try:
+        _write_chat_snapshot(chat_id, cols, cols.base, chat_archive.get(chat_id))
+        _journal_reset(chat_id)
+    except Exception as e:
+        print(f"Ошибка сохранения истории чата {chat_id}:", repr(e))
+
+def _update_chat_meta(chat_id: str, cols: ChatColumns) -> None:
+    meta = chat_meta.get(chat_id)
+    if meta is None:
+        meta = chat_meta[chat_id] = {"count": 0, "base": 0, "last_ts": 0}
+    meta["count"] = cols.end
+    meta["base"] = cols.base
+    meta["last_ts"] = cols.ts[-1] if len(cols) else 0
+
+def load_chat_meta() -> None:
+    """
+    Метаданные, записанные раньше, чем менялись файлы чата (падение между сбросом
+    журнала и сохранением метаданных), не используем: такой чат проверим по истории.
+    """
+    try:
+        if not os.path.exists(CHAT_META_FILE):
+            return
+        meta_mtime = os.stat(CHAT_META_FILE).st_mtime_ns
+        data = read_snapshot_file(CHAT_META_FILE, {})
+        for chat_id, meta in data.items():
+            if chat_id in chat_messages:
+                continue
+            sigs = (_file_signature(_chat_snapshot_path(chat_id)), _file_signature(_chat_journal_path(chat_id)))
+            if any(sig is not None and sig[0] > meta_mtime for sig in sigs):
+                chat_meta.pop(chat_id, None)
+                continue
+            chat_meta[chat_id] = {
+                "count": int(meta.get("count", 0)),
+                "base": int(meta.get("base", 0)),
+                "last_ts": int(meta.get("last_ts", 0)),
+            }
+    except Exception as e:
+        print("Ошибка загрузки chat_meta:", repr(e))
+
+def save_chat_meta() -> None:
+    try:
+        write_snapshot_file(CHAT_META_FILE, {k: dict(v) for k, v in list(chat_meta.items())})
+    except Exception as e:
+        print("Ошибка сохранения chat_meta:", repr(e))
+
+def save_summary_index() -> None:
+    try:
+        write_snapshot_file(SUMMARY_INDEX_FILE, dict(list(last_summary_index.items())), indent=2)
+    except Exception as e:
+        print("Ошибка сохранения summary_index:", repr(e))
+
+def load_history() -> None:
+    """
+    Загружает с диска общие маленькие файлы: индексы сводок, monthly_stats, конспекты.
+    Сами истории чатов поднимаются лениво (chat_messages[chat_id]).
+    """
+    try:
+        for chat_id, idx_int in _read_summary_index().items():
+            if chat_id in last_summary_index:
+                last_summary_index[chat_id] = max(last_summary_index[chat_id], idx_int)
+            else:
+                last_summary_index[chat_id] = idx_int
 
         load_monthly_stats_sent()
+        load_summary_digests()
+        load_chat_meta()
+        _remember_disk_state(SUMMARY_INDEX_FILE, MONTHLY_STATS_SENT_FILE, SUMMARY_DIGEST_FILE)
 
     except Exception as e:
         print("Ошибка загрузки истории:", repr(e))
 
 def save_history() -> None:
-    try:
-        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(dict(chat_messages), f, ensure_ascii=False, indent=2)
+    """
+    Снапшоты всех загруженных чатов + общие файлы.
+    """
+    for chat_id, cols in list(chat_messages.items()):
+        save_chat(chat_id, cols)
+    save_summary_index()
+    save_monthly_stats_sent()
+    save_chat_meta()
 
-        with open(SUMMARY_INDEX_FILE, "w", encoding="utf-8") as f:
-            json.dump(dict(last_summary_index), f, ensure_ascii=False, indent=2)
+# -----------------------------------------
+# АГРЕГАТЫ ПО МЕСЯЦАМ
+# Счётчики обновляются при каждом новом сообщении, поэтому /stats
+# и monthly_stats_job за календарный месяц стоят O(число пользователей), а не O(история).
+# -----------------------------------------
+_MEDIA_TYPES = ("photo", "video", "voice", "document")
 
-        save_monthly_stats_sent()
-    except Exception as e:
-        print("Ошибка сохранения истории:", repr(e))
+# chat_id -> "YYYY-MM" -> {"total", "user_text", "user_media", "media"}
+month_aggregates: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+def _month_key(dt: datetime) -> str:
+    return dt.astimezone(BOT_TZ).strftime("%Y-%m")
+
+def _whole_month_key(period_start: datetime, period_end: datetime) -> Optional[str]:
+    """
+    "YYYY-MM", если [period_start, period_end) — ровно один календарный месяц, иначе None.
+    """
+    start, end = _month_range_for(period_start)
+    if start == period_start.astimezone(BOT_TZ) and end == period_end.astimezone(BOT_TZ):
+        return _month_key(period_start)
+    return None
+
+def _aggregate(chat_id: str, ts: int, u: str, t: str) -> None:
+    _aggregate_month(chat_id, _month_key(datetime.fromtimestamp(ts, BOT_TZ)), u, t)
+
+def _empty_aggregate() -> Dict[str, Any]:
+    return {"total": 0, "user_text": {}, "user_media": {}, "media": {t: 0 for t in _MEDIA_TYPES}}
+
+def _aggregate_month(chat_id: str, key: str, u: str, t: str, n: int = 1) -> None:
+    agg = month_aggregates.setdefault(chat_id, {}).get(key)
+    if agg is None:
+        agg = month_aggregates[chat_id][key] = _empty_aggregate()
+    _aggregate_add(agg, u, t, n)
+
+def _aggregate_add(agg: Dict[str, Any], u: str, t: str, n: int = 1) -> None:
+    agg["total"] += n
+    if t == "text":
+        agg["user_text"][u] = agg["user_text"].get(u, 0) + n
+    else:
+        agg["user_media"][u] = agg["user_media"].get(u, 0) + n
+        if t in agg["media"]:
+            agg["media"][t] += n
+
+def _period_bounds(chat_id: str, period_start: datetime, period_end: datetime) -> Tuple[int, int]:
+    """
+    [lo, hi) — строки ChatColumns чата внутри периода (бинарный поиск по колонке ts).
+    """
+    idx = chat_messages[chat_id].ts
+    lo = bisect.bisect_left(idx, int(period_start.timestamp()))
+    hi = bisect.bisect_left(idx, int(period_end.timestamp()), lo)
+    return lo, hi
+
+def rebuild_month_aggregates(chat_id: Optional[str] = None, cols: Optional[ChatColumns] = None) -> None:
+    """
+    Полный пересчёт агрегатов (при загрузке чата). Дальше они ведутся инкрементально.
+    """
+    chat_ids = [chat_id] if chat_id is not None else list(chat_messages.keys())
+    for cid in chat_ids:
+        month_aggregates.pop(cid, None)
+        for (key, u, t), n in chat_archive.get(cid, {}).items():
+            _aggregate_month(cid, key, u, t, n)
+        if cols is None or cid != chat_id:
+            cols = chat_messages.get(cid)
+        if cols is None:
+            continue
+
+        # ts неубывающий: месяц — непрерывный отрезок строк, его границы ищем бинарным поиском
+        # и считаем (имя, тип) по срезам колонок, без разбора даты каждого сообщения
+        i, n = 0, len(cols)
+        while i < n:
+            dt = datetime.fromtimestamp(cols.ts[i], BOT_TZ)
+            _, month_end = _month_range_for(dt)
+            j = bisect.bisect_left(cols.ts, int(month_end.timestamp()), i)
+            key = _month_key(dt)
+            for (name_id, code), c in Counter(zip(cols.name_ids[i:j], cols.types[i:j])).items():
+                _aggregate_month(cid, key, cols.names[name_id], _MSG_TYPES[code], c)
+            i = max(j, i + 1)
+
+def _new_in_period(chat_id: str, cols: ChatColumns, last_i: int, period_start: datetime, period_end: datetime) -> Tuple[int, int]:
+    """
+    (сообщений, медиа) после last_summary_index внутри периода — без разбора дат.
+    """
+    lo, hi = _period_bounds(chat_id, period_start, period_end)
+    lo = max(lo, (last_i or 0) - cols.base, 0)
+    if lo >= hi:
+        return 0, 0
+    new_media = sum(1 for code in cols.types[lo:hi] if code != 0)
+    return hi - lo, new_media
+
+def _stats_from_month_aggregate(agg: Optional[Dict[str, Any]], new: int, new_media: int) -> Dict[str, Any]:
+    if agg is None:
+        agg = _empty_aggregate()
+    return {
+        "total": agg["total"],
+        "new": new,
+        "new_media": new_media,
+        "user_msg_count": dict(agg["user_text"]),
+        "user_media_count": dict(agg["user_media"]),
+        "total_media": dict(agg["media"]),
+    }
+
+
+def _period_stats_from_segment(
+    chat_id: str,
+    last_i: int,
+    period_start: datetime,
+    period_end: datetime
+) -> Optional[Dict[str, Any]]:
+    """
+    Статистика за период для выгруженного чата без его загрузки:
+    снапшот "columns" через mmap (бинарный поиск по ts + строки периода) и хвост журнала.
+    None — снапшот в другом формате или не читается: тогда чат поднимаем целиком.
+    """
+    start_ts, end_ts = int(period_start.timestamp()), int(period_end.timestamp())
+    last_i = max(last_i or 0, 0)
+    agg = _empty_aggregate()
 
-def save_message_immediately(chat_id: str) -> None:
     try:
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                existing_data = json.load(f)
-        else:
-            existing_data = {}
+        with write_buffer.exclusive(), ChatSegment(_chat_snapshot_path(chat_id)) as seg:
+            lo = bisect.bisect_left(seg.ts, start_ts)
+            hi = bisect.bisect_left(seg.ts, end_ts, lo)
+            name_ids = seg.columns["name_ids"].slice(lo, hi)
+            types = seg.columns["types"].slice(lo, hi)
+            for (name_id, code), c in Counter(zip(name_ids, types)).items():
+                _aggregate_add(agg, seg.names[name_id], _MSG_TYPES[code], c)
+
+            new_lo = min(max(lo, last_i - seg.base), hi)
+            new = hi - new_lo
+            new_media = sum(1 for code in types[new_lo - lo:] if code != 0)
+
+            month_key = _whole_month_key(period_start, period_end)
+            for u, t, c in seg.archive.get(month_key, []) if month_key else []:
+                _aggregate_add(agg, u, t, c)
+
+            # Хвост журнала: сообщения после снапшота
+            seg_end = seg.base + len(seg)
+            history: Dict[str, list] = {chat_id: []}
+            bases = {chat_id: seg_end}
+            _replay_journal(_chat_journal_path(chat_id), history, {}, bases)
+            if bases[chat_id] != seg_end:
+                return None  # в журнале очистка чата — снапшот уже не актуален
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        print(f"Статистика чата {chat_id} через mmap недоступна:", repr(e))
+        return None
+
+    for position, m in enumerate(history[chat_id], seg_end):
+        ts = _msg_epoch(m)
+        if ts is None or not start_ts <= ts < end_ts:
+            continue
+        t = m.get("type", "text")
+        _aggregate_add(agg, m.get("username", "Аноним"), t, 1)
+        if position >= last_i:
+            new += 1
+            new_media += t != "text"
 
-        existing_data[chat_id] = chat_messages.get(chat_id, [])
+    return _stats_from_month_aggregate(agg, new, new_media)
 
-        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(existing_data, f, ensure_ascii=False, indent=2)
+# -----------------------------------------
+# ХРАНИЛИЩЕ: политика хранения (RETENTION_*)
+# Позиции абсолютные (base в ChatColumns, seq в sqlite), поэтому после удаления
+# last_summary_index и конспекты переписывать не нужно.
+# -----------------------------------------
+def _retention_cut(end: int, last_i: int, keep_from_pos: int) -> int:
+    """
+    Абсолютная позиция, до которой (не включая) сообщения можно удалить.
+    keep_from_pos — позиция первого сообщения моложе RETENTION_KEEP_DAYS.
+    Последнее сообщение не удаляем никогда: по нему считается число сообщений чата.
+    """
+    cut = min(last_i - RETENTION_KEEP_MESSAGES, end - 1)
+    if RETENTION_KEEP_DAYS > 0:
+        cut = min(cut, keep_from_pos)
+    return max(cut, 0)
 
-        with open(SUMMARY_INDEX_FILE, "w", encoding="utf-8") as f:
-            json.dump(dict(last_summary_index), f, ensure_ascii=False, indent=2)
+# -----------------------------------------
+# ХРАНИЛИЩЕ: отложенная запись (write-behind)
+# Хендлеры кладут записи в буфер и сразу возвращаются.
+# Фоновая задача сбрасывает пачку через asyncio.to_thread, когда:
+# - прошло WRITE_BEHIND_MAX_DELAY_MS с первой несброшенной записи
+# - или набралось WRITE_BEHIND_MAX_PENDING записей
+# Пока буфер не запущен (старт, скрипты) или задержка 0 — запись идёт сразу.
+# -----------------------------------------
+class WriteBehindBuffer:
+    def __init__(
+        self,
+        flush_fn: Callable[[list], None],
+        max_delay_ms: int,
+        max_pending: int,
+        after_flush: Optional[Callable[[], None]] = None,
+        max_retries: int = 5,
+        failed_path: Optional[str] = None,
+    ):
+        self.flush_fn = flush_fn
+        # Вызывается в цикле событий после фонового сброса (например, догнать отложенную выгрузку чатов)
+        self.after_flush = after_flush
+        self.max_delay = max(max_delay_ms, 0) / 1000
+        self.max_pending = max(max_pending, 1)
+        # Пачка, которая не сбросилась max_retries раз подряд, дописывается в failed_path и снимается с очереди
+        self.max_retries = max(max_retries, 1)
+        self.failed_path = failed_path
+        self._failures = 0
+        self._pending: list = []
+        self._inflight: list = []  # пачка, которую сейчас пишет flush_fn
+        self._pending_lock = threading.Lock()
+        # Сброс и всё, что читает диск/базу в обход памяти, идут под этим локом
+        self._flush_lock = threading.RLock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.flushed_batches = 0
+        self.flushed_records = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and self.max_delay > 0
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def pending_records(self) -> list:
+        """
+        Записи, которых ещё нет на диске: накопленные и сбрасываемые прямо сейчас.
+        """
+        with self._pending_lock:
+            return self._inflight + self._pending
+
+    def put(self, record: Any) -> None:
+        with self._pending_lock:
+            self._pending.append(record)
+            n = len(self._pending)
+
+        if not self.running:
+            self.flush_now()
+        elif n == 1 or n >= self.max_pending:
+            self._wakeup.set()
+
+    def flush_now(self) -> int:
+        """
+        Синхронно сбрасывает всё накопленное. Возвращает число записей.
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+                self._inflight = batch
+            if not batch:
+                return 0
+            try:
+                self.flush_fn(batch)
+            except Exception as e:
+                self._failures += 1
+                print(f"Ошибка сброса буфера записи ({len(batch)} записей, попытка {self._failures}):", repr(e))
+                if self._failures >= self.max_retries:
+                    self._failures = 0
+                    self._set_aside(batch, e)
+                    with self._pending_lock:
+                        self._inflight = []
+                    return 0
+                # Возвращаем пачку в начало очереди — попробуем ещё раз
+                with self._pending_lock:
+                    self._pending[:0] = batch
+                    self._inflight = []
+                return 0
+            self._failures = 0
+            with self._pending_lock:
+                self._inflight = []
+            self.flushed_batches += 1
+            self.flushed_records += len(batch)
+            return len(batch)
+
+    def _set_aside(self, batch: list, exc: Exception) -> None:
+        """
+        Пачка, которая так и не сбросилась: дописываем её в failed_path, чтобы очередь пошла дальше.
+        """
+        error_id = uuid.uuid4().hex[:8]
+        log_error(error_id, "write_buffer.flush", exc, {"records": len(batch), "failed_path": self.failed_path})
+        if self.failed_path is None:
+            return
+        try:
+            with open(self.failed_path, "a", encoding="utf-8") as f:
+                for record in batch:
+                    f.write(json.dumps({"error_id": error_id, "record": record}, ensure_ascii=False, default=str) + "\n")
+        except Exception as e:
+            print(f"Не удалось отложить пачку буфера записи ({len(batch)} записей) в {self.failed_path}:", repr(e))
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Сбросить буфер и не давать фоновому сбросу стартовать, пока мы внутри.
+        """
+        with self._flush_lock:
+            self.flush_now()
+            yield
+
+    @contextmanager
+    def hold(self, blocking: bool = True):
+        """
+        Не давать фоновому сбросу стартовать, ничего не сбрасывая. Отдаёт True, если лок взят
+        (с blocking=False — только если сброс сейчас не идёт).
+        """
+        held = self._flush_lock.acquire(blocking)
+        try:
+            yield held
+        finally:
+            if held:
+                self._flush_lock.release()
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            # Даём набраться пачке, но не дольше окна устойчивости
+            deadline = _time.monotonic() + self.max_delay
+            while self.pending() < self.max_pending:
+                left = deadline - _time.monotonic()
+                if left <= 0:
+                    break
+                self._wakeup.clear()
+                # asyncio.timeout, а не wait_for: в 3.11 wait_for может проглотить отмену из stop()
+                try:
+                    async with asyncio.timeout(left):
+                        await self._wakeup.wait()
+                except TimeoutError:
+                    break
+            self._wakeup.clear()
+            await asyncio.to_thread(self.flush_now)
+            if self.after_flush is not None:
+                try:
+                    self.after_flush()
+                except Exception as e:
+                    print("Ошибка после сброса буфера записи:", repr(e))
+
+    def start(self) -> None:
+        if self.max_delay <= 0 or self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        if self._pending:
+            self._wakeup.set()
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        n = await asyncio.to_thread(self.flush_now)
+        print(f"Буфер записи: финальный сброс {n} записей "
+              f"(всего {self.flushed_records} записей в {self.flushed_batches} пачках)")
+
+def _with_flushed_writes(method):
+    """
+    Для методов, которые читают/пишут базу напрямую: сначала досбросить буфер.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with write_buffer.exclusive():
+            return method(*args, **kwargs)
+    return wrapper
+
+# -----------------------------------------
+# ХРАНИЛИЩЕ: бэкенды (json / sqlite)
+# -----------------------------------------
+# Подмена колонок чата (compact из потока) и дозапись в них (append в цикле событий)
+_chat_swap_lock = threading.Lock()
 
+class JsonHistoryStore:
+    """
+    История по шардам в CHATS_DIR (снапшот + журнал на чат).
+    В памяти (chat_messages) — только чаты, к которым уже обращались.
+    """
+    name = "json"
+
+    def load(self) -> None:
+        migrate_legacy_history()
+        load_history()
+
+    def refresh(self, chat_id: Optional[str] = None) -> None:
+        """
+        Общие файлы и шарды загруженных чатов (или только chat_id), изменённые извне,
+        перечитываем: изменённый чат выгружается и поднимется заново при обращении.
+        Вызывается из потока: хендлеры могут дописывать в это время, такие чаты не выгружаем.
+        """
+        with write_buffer.exclusive():
+            if history_changed_on_disk():
+                print("Индексы сводок изменены извне — перечитываем")
+                load_history()
+
+            busy = {str(r.get("chat_id")) for r in write_buffer.pending_records()}
+            chat_ids = [chat_id] if chat_id is not None else list(chat_messages.keys())
+            for cid in chat_ids:
+                if cid in chat_messages and cid not in busy and chat_changed_on_disk(cid):
+                    print(f"История чата {cid} изменена извне — перечитываем")
+                    with _chat_swap_lock:
+                        del chat_messages[cid]
+                    month_aggregates.pop(cid, None)
+                    chat_archive.pop(cid, None)
+
+    def save(self) -> None:
+        with write_buffer.exclusive():
+            save_history()
+
+    def close(self) -> None:
+        with write_buffer.exclusive():
+            save_chat_meta()
+
+    def snapshot(self) -> int:
+        """
+        Сворачивает непустые журналы загруженных чатов в снапшоты. Вызывается из потока:
+        каждый чат — под локом буфера записи, чтобы сброс не вклинился между снапшотом и обнулением журнала.
+        """
+        done = 0
+        for chat_id in list(chat_messages.keys()):
+            with write_buffer.exclusive():
+                if _journal_records[chat_id] > 0 and dict.get(chat_messages, chat_id) is not None:
+                    save_chat(chat_id)
+                    done += 1
+        # Метаданные — здесь и при остановке, а не на каждую пачку буфера записи.
+        # Если после этого чат успеет поменяться, load_chat_meta отбросит его устаревшую запись.
+        with write_buffer.exclusive():
+            save_chat_meta()
+        return done
+
+    def flush_batch(self, records: list) -> None:
+        """
+        Вызывается буфером записи (из фонового потока): пачка в журналы чатов,
+        переполненные журналы сворачиваются в снапшот своего чата.
+        chat_meta здесь не пишем (см. snapshot).
+        """
+        _journal_write_many(records)
+        for chat_id in {str(r.get("chat_id")) for r in records}:
+            if _journal_records[chat_id] >= JOURNAL_COMPACT_EVERY:
+                save_chat(chat_id)
+
+    def chat_ids(self) -> list:
+        return sorted(set(stored_chat_ids()) | set(chat_messages.keys()))
+
+    def count(self, chat_id: str) -> int:
+        return chat_messages[chat_id].end
+
+    def has_new_messages(self, chat_id: str, since: int, at_least: int = 1) -> bool:
+        """
+        Есть ли хотя бы at_least сообщений после позиции since.
+        Для выгруженного чата отвечаем по chat_meta, не поднимая историю.
+        """
+        cols = chat_messages.get(chat_id)
+        if cols is not None:
+            return cols.end - since >= at_least
+        meta = chat_meta.get(chat_id)
+        if meta is None:
+            return self.count(chat_id) - since >= at_least
+        return meta["count"] - since >= at_least
+
+    def messages_from(self, chat_id: str, start: int) -> list:
+        cols = chat_messages[chat_id]
+        return list(cols.rows(start - cols.base))
+
+    def period_stats(self, chat_id: str, last_i: int, period_start: datetime, period_end: datetime) -> Dict[str, Any]:
+        # Выгруженный чат не поднимаем: статистика читается из снапшота через mmap
+        if chat_id not in chat_messages:
+            stats = _period_stats_from_segment(chat_id, last_i, period_start, period_end)
+            if stats is not None:
+                return stats
+
+        cols = chat_messages[chat_id]
+        month_key = _whole_month_key(period_start, period_end)
+        if month_key is None:
+            lo, hi = _period_bounds(chat_id, period_start, period_end)
+            return _period_stats_from_columns(cols, lo, hi, (last_i or 0) - cols.base)
+
+        new, new_media = _new_in_period(chat_id, cols, last_i, period_start, period_end)
+        agg = month_aggregates.get(chat_id, {}).get(month_key)
+        return _stats_from_month_aggregate(agg, new, new_media)
+
+    def append(self, chat_id: str, message_data: Dict[str, Any]) -> None:
+        while True:
+            cols = chat_messages[chat_id]
+            # compact из потока мог подменить колонки чата — дописываем только в текущие
+            with _chat_swap_lock:
+                if dict.get(chat_messages, chat_id) is cols:
+                    cols.append(message_data)
+                    i = len(cols) - 1
+                    break
+        _aggregate(chat_id, cols.ts[i], cols.username(i), cols.msg_type(i))
+        _update_chat_meta(chat_id, cols)
+        journal_message(chat_id, cols.base + i, message_data)
+
+        chat_messages.note_append()
+        if chat_messages.resident_messages > RESIDENT_MAX_MESSAGES:
+            chat_messages.evict(keep=chat_id)
+
+    def set_summary_index(self, chat_id: str, idx: int) -> None:
+        last_summary_index[chat_id] = idx
+        # Индекс не должен опережать сообщения на диске
+        with write_buffer.exclusive():
+            save_summary_index()
+        # Конспект относился к старому last_summary_index
+        if running_digest.pop(chat_id, None) is not None:
+            save_summary_digests()
+
+    def set_digest(self, chat_id: str, digest: Dict[str, Any]) -> None:
+        running_digest[chat_id] = digest
+        save_summary_digests()
+
+    def clear(self, chat_id: str) -> None:
+        with _chat_swap_lock:
+            chat_messages[chat_id] = ChatColumns()
+        month_aggregates.pop(chat_id, None)
+        chat_archive.pop(chat_id, None)
+        _update_chat_meta(chat_id, chat_messages[chat_id])
+        last_summary_index[chat_id] = 0
+        monthly_stats_last_sent[chat_id] = ""
+
+        # Пустой снапшот вместо записи "clear" в журнал: вместе с историей уходит и архив агрегатов
+        with write_buffer.exclusive():
+            save_chat(chat_id)
+            save_summary_index()
         save_monthly_stats_sent()
+        if running_digest.pop(chat_id, None) is not None:
+            save_summary_digests()
 
-    except Exception as e:
-        print(f"Ошибка немедленного сохранения для чата {chat_id}:", repr(e))
+    def save_monthly_stats_sent(self) -> None:
+        save_monthly_stats_sent()
+
+    def compact(self, chat_id: str, now_ts: int) -> int:
+        """
+        Удаляет старые сообщения по политике хранения. Их месячные агрегаты
+        переезжают в chat_archive. Возвращает число удалённых сообщений.
+        Вызывается из потока: append в это время дописывает в те же колонки,
+        поэтому хвост копируется и подменяется под _chat_swap_lock.
+        """
+        last_i = last_summary_index.get(chat_id, 0)
+        if chat_id not in chat_messages:
+            meta = chat_meta.get(chat_id)
+            if meta is not None and last_i - RETENTION_KEEP_MESSAGES <= meta.get("base", 0):
+                return 0
+
+        cols = chat_messages[chat_id]
+        keep_from_pos = cols.base + bisect.bisect_left(cols.ts, now_ts - RETENTION_KEEP_DAYS * 86400)
+        cut = _retention_cut(cols.end, last_i, keep_from_pos)
+        lo = cut - cols.base
+        if lo <= 0:
+            return 0
+
+        with write_buffer.exclusive():
+            archive = chat_archive.setdefault(chat_id, {})
+            for i in range(lo):
+                key = (_month_key(datetime.fromtimestamp(cols.ts[i], BOT_TZ)), cols.username(i), cols.msg_type(i))
+                archive[key] = archive.get(key, 0) + 1
+
+            with _chat_swap_lock:
+                compacted = cols.tail(lo)
+                chat_messages[chat_id] = compacted
+                _update_chat_meta(chat_id, compacted)
+            save_chat(chat_id, compacted)
+        return lo
+
+class SqliteHistoryStore:
+    """
+    История в SQLite (WAL). Позиция сообщения в чате хранится в seq,
+    поэтому last_summary_index по-прежнему означает "сколько сообщений уже в сводке".
+    """
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        self._data_version: Optional[int] = None
+        self._imported_archive: Dict[Tuple[str, str, str, str], int] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS messages (
+                    chat_id   TEXT    NOT NULL,
+                    seq       INTEGER NOT NULL,
+                    ts        INTEGER,
+                    timestamp TEXT,
+                    username  TEXT,
+                    user_id   INTEGER,
+                    text      TEXT,
+                    type      TEXT    NOT NULL DEFAULT 'text',
+                    PRIMARY KEY (chat_id, seq)
+                );
+                CREATE INDEX IF NOT EXISTS idx_messages_chat_ts ON messages (chat_id, ts);
+                CREATE INDEX IF NOT EXISTS idx_messages_type ON messages (type);
+                CREATE TABLE IF NOT EXISTS summary_index (
+                    chat_id TEXT PRIMARY KEY,
+                    idx     INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS monthly_stats_sent (
+                    chat_id   TEXT PRIMARY KEY,
+                    month_key TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS summary_digest (
+                    chat_id  TEXT PRIMARY KEY,
+                    from_idx INTEGER NOT NULL,
+                    upto     INTEGER NOT NULL,
+                    text     TEXT    NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS month_aggregates (
+                    chat_id  TEXT    NOT NULL,
+                    month    TEXT    NOT NULL,
+                    username TEXT    NOT NULL,
+                    type     TEXT    NOT NULL,
+                    count    INTEGER NOT NULL,
+                    PRIMARY KEY (chat_id, month, username, type)
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key   TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                """
+            )
+            self.conn = conn
+        return self.conn
+
+    @staticmethod
+    def _row(chat_id: str, seq: int, m: Dict[str, Any]) -> tuple:
+        return (
+            chat_id,
+            seq,
+            _msg_epoch(m),
+            m.get("timestamp"),
+            m.get("username", "Аноним"),
+            m.get("user_id"),
+            m.get("text", ""),
+            m.get("type", "text"),
+        )
+
+    def _import_json_once(self, conn: sqlite3.Connection) -> None:
+        """
+        Однократный импорт JSON-истории (старый HISTORY_FILE и шарды CHATS_DIR) + индексов в пустую базу.
+        """
+        done = conn.execute("SELECT value FROM meta WHERE key = 'json_imported'").fetchone()
+        if done:
+            return
+
+        data, index_data, bases, archives = _read_json_history()
+        load_monthly_stats_sent()
+        load_summary_digests()
+        # Агрегаты сообщений, удалённых политикой хранения, добавит _build_aggregates_once
+        self._imported_archive = {
+            (chat_id,) + key: c for chat_id, archive in archives.items() for key, c in archive.items()
+        }
+
+        conn.execute("BEGIN")
+        try:
+            for chat_id, messages in data.items():
+                base = bases.get(chat_id, 0)
+                conn.executemany(
+                    "INSERT OR IGNORE INTO messages (chat_id, seq, ts, timestamp, username, user_id, text, type) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self._row(chat_id, base + i, m) for i, m in enumerate(messages)),
+                )
+            conn.executemany(
+                "INSERT OR REPLACE INTO summary_index (chat_id, idx) VALUES (?, ?)",
+                list(index_data.items()),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO monthly_stats_sent (chat_id, month_key) VALUES (?, ?)",
+                list(monthly_stats_last_sent.items()),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO summary_digest (chat_id, from_idx, upto, text) VALUES (?, ?, ?, ?)",
+                [(k, d["from"], d["upto"], d["text"]) for k, d in running_digest.items()],
+            )
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', ?)", (_now_tz().isoformat(),))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        total = sum(len(v) for v in data.values())
+        print(f"SQLite: импортировано {total} сообщений из {len(data)} чатов (JSON)")
+
+    _AGG_UPSERT = (
+        "INSERT INTO month_aggregates (chat_id, month, username, type, count) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (chat_id, month, username, type) DO UPDATE SET count = count + excluded.count"
+    )
+
+    def _build_aggregates_once(self, conn: sqlite3.Connection) -> None:
+        """
+        Однократный пересчёт month_aggregates по уже лежащим в базе сообщениям.
+        """
+        done = conn.execute("SELECT value FROM meta WHERE key = 'aggregates_built'").fetchone()
+        if done:
+            return
+
+        counts: Dict[Tuple[str, str, str, str], int] = defaultdict(int)
+        for chat_id, ts, username, t in conn.execute("SELECT chat_id, ts, username, type FROM messages"):
+            if ts is None:
+                continue
+            month = _month_key(datetime.fromtimestamp(ts, BOT_TZ))
+            counts[(chat_id, month, username or "Аноним", t)] += 1
+        for key, c in self._imported_archive.items():
+            counts[key] += c
+
+        conn.execute("BEGIN")
+        try:
+            conn.execute("DELETE FROM month_aggregates")
+            conn.executemany(self._AGG_UPSERT, [k + (c,) for k, c in counts.items()])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('aggregates_built', ?)", (_now_tz().isoformat(),))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _load_indexes(self, conn: sqlite3.Connection) -> None:
+        for chat_id, idx in conn.execute("SELECT chat_id, idx FROM summary_index"):
+            last_summary_index[chat_id] = int(idx)
+        for chat_id, month_key in conn.execute("SELECT chat_id, month_key FROM monthly_stats_sent"):
+            monthly_stats_last_sent[chat_id] = str(month_key)
+        running_digest.clear()
+        for chat_id, from_idx, upto, text in conn.execute("SELECT chat_id, from_idx, upto, text FROM summary_digest"):
+            running_digest[chat_id] = {"from": int(from_idx), "upto": int(upto), "text": text}
+        self._data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def load(self) -> None:
+        try:
+            conn = self._connect()
+            self._import_json_once(conn)
+            self._build_aggregates_once(conn)
+            self._load_indexes(conn)
+        except Exception as e:
+            print("Ошибка загрузки истории (sqlite):", repr(e))
+
+    @_with_flushed_writes
+    def refresh(self, chat_id: Optional[str] = None) -> None:
+        """
+        Сообщения читаются из базы напрямую. Индексы сводок в памяти
+        перечитываем, только если базу менял другой процесс (PRAGMA data_version).
+        """
+        try:
+            conn = self._connect()
+            if conn.execute("PRAGMA data_version").fetchone()[0] != self._data_version:
+                self._load_indexes(conn)
+        except Exception as e:
+            print("Ошибка обновления индексов (sqlite):", repr(e))
+
+    def save(self) -> None:
+        # Каждая запись фиксируется сразу (autocommit)
+        return
+
+    @_with_flushed_writes
+    def snapshot(self) -> int:
+        # Аналог снапшота для sqlite — перенести WAL в основной файл и обрезать его
+        busy, _, checkpointed = self._connect().execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        return 0 if busy else max(checkpointed, 0)
+
+    def close(self) -> None:
+        with write_buffer.exclusive():
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    @_with_flushed_writes
+    def chat_ids(self) -> list:
+        return [r[0] for r in self._connect().execute("SELECT DISTINCT chat_id FROM messages")]
+
+    @_with_flushed_writes
+    def count(self, chat_id: str) -> int:
+        row = self._connect().execute(
+            "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        return int(row[0])
+
+    def has_new_messages(self, chat_id: str, since: int, at_least: int = 1) -> bool:
+        # MAX(seq) по первичному ключу — дешёвый запрос
+        return self.count(chat_id) - since >= at_least
+
+    @_with_flushed_writes
+    def compact(self, chat_id: str, now_ts: int) -> int:
+        """
+        Удаляет старые сообщения по политике хранения. month_aggregates — отдельная
+        таблица, поэтому месячная статистика не меняется. Возвращает число удалённых сообщений.
+        """
+        conn = self._connect()
+        end = self.count(chat_id)
+        row = conn.execute(
+            "SELECT MIN(seq) FROM messages WHERE chat_id = ? AND ts >= ?",
+            (chat_id, now_ts - RETENTION_KEEP_DAYS * 86400),
+        ).fetchone()
+        keep_from_pos = row[0] if row[0] is not None else end
+        cut = _retention_cut(end, last_summary_index.get(chat_id, 0), keep_from_pos)
+        if cut <= 0:
+            return 0
+        cur = conn.execute("DELETE FROM messages WHERE chat_id = ? AND seq < ?", (chat_id, cut))
+        return max(cur.rowcount, 0)
+
+    @_with_flushed_writes
+    def messages_from(self, chat_id: str, start: int) -> list:
+        rows = self._connect().execute(
+            "SELECT username, user_id, text, ts, type FROM messages "
+            "WHERE chat_id = ? AND seq >= ? ORDER BY seq",
+            (chat_id, max(start, 0)),
+        )
+        return [
+            {"username": u, "user_id": uid, "text": t or "", "ts": ts, "type": tp}
+            for u, uid, t, ts, tp in rows
+        ]
+
+    @_with_flushed_writes
+    def period_stats(self, chat_id: str, last_i: int, period_start: datetime, period_end: datetime) -> Dict[str, Any]:
+        conn = self._connect()
+        start_ts = int(period_start.timestamp())
+        end_ts = int(period_end.timestamp())
+
+        user_msg_count: Dict[str, int] = {}
+        user_media_count: Dict[str, int] = {}
+        total_media = {t: 0 for t in _MEDIA_TYPES}
+        total = 0
+
+        month_key = _whole_month_key(period_start, period_end)
+        if month_key is not None:
+            rows = conn.execute(
+                "SELECT username, type, count FROM month_aggregates WHERE chat_id = ? AND month = ?",
+                (chat_id, month_key),
+            )
+        else:
+            rows = conn.execute(
+                "SELECT username, type, COUNT(*) FROM messages "
+                "WHERE chat_id = ? AND ts >= ? AND ts < ? GROUP BY username, type",
+                (chat_id, start_ts, end_ts),
+            )
+        for u, t, c in rows:
+            u = u or "Аноним"
+            total += c
+            if t == "text":
+                user_msg_count[u] = user_msg_count.get(u, 0) + c
+            else:
+                user_media_count[u] = user_media_count.get(u, 0) + c
+                if t in total_media:
+                    total_media[t] += c
+
+        new, new_media = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(type != 'text'), 0) FROM messages "
+            "WHERE chat_id = ? AND ts >= ? AND ts < ? AND seq >= ?",
+            (chat_id, start_ts, end_ts, max(last_i or 0, 0)),
+        ).fetchone()
+
+        return {
+            "total": total,
+            "new": int(new),
+            "new_media": int(new_media),
+            "user_msg_count": user_msg_count,
+            "user_media_count": user_media_count,
+            "total_media": total_media,
+        }
+
+    def append(self, chat_id: str, message_data: Dict[str, Any]) -> None:
+        write_buffer.put((chat_id, message_data))
+
+    def flush_batch(self, batch: list) -> None:
+        """
+        Вызывается буфером записи: вся пачка сообщений — одной транзакцией.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            for chat_id, message_data in batch:
+                row = self._row(chat_id, 0, message_data)
+                conn.execute(
+                    "INSERT INTO messages (chat_id, seq, ts, timestamp, username, user_id, text, type) "
+                    "VALUES (?, (SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE chat_id = ?), ?, ?, ?, ?, ?, ?)",
+                    (chat_id, chat_id) + row[2:],
+                )
+                if row[2] is not None:
+                    month = _month_key(datetime.fromtimestamp(row[2], BOT_TZ))
+                    conn.execute(self._AGG_UPSERT, (chat_id, month, row[4], row[7], 1))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @_with_flushed_writes
+    def set_summary_index(self, chat_id: str, idx: int) -> None:
+        last_summary_index[chat_id] = idx
+        running_digest.pop(chat_id, None)
+        try:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO summary_index (chat_id, idx) VALUES (?, ?)", (chat_id, idx))
+            conn.execute("DELETE FROM summary_digest WHERE chat_id = ?", (chat_id,))
+        except Exception as e:
+            print(f"Ошибка сохранения индекса сводки для чата {chat_id}:", repr(e))
+
+    @_with_flushed_writes
+    def set_digest(self, chat_id: str, digest: Dict[str, Any]) -> None:
+        running_digest[chat_id] = digest
+        try:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO summary_digest (chat_id, from_idx, upto, text) VALUES (?, ?, ?, ?)",
+                (chat_id, digest["from"], digest["upto"], digest["text"]),
+            )
+        except Exception as e:
+            print(f"Ошибка сохранения конспекта для чата {chat_id}:", repr(e))
+
+    @_with_flushed_writes
+    def clear(self, chat_id: str) -> None:
+        last_summary_index[chat_id] = 0
+        monthly_stats_last_sent[chat_id] = ""
+        running_digest.pop(chat_id, None)
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+            conn.execute("DELETE FROM month_aggregates WHERE chat_id = ?", (chat_id,))
+            conn.execute("DELETE FROM summary_digest WHERE chat_id = ?", (chat_id,))
+            conn.execute("INSERT OR REPLACE INTO summary_index (chat_id, idx) VALUES (?, 0)", (chat_id,))
+            conn.execute("DELETE FROM monthly_stats_sent WHERE chat_id = ?", (chat_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @_with_flushed_writes
+    def save_monthly_stats_sent(self) -> None:
+        try:
+            self._connect().executemany(
+                "INSERT OR REPLACE INTO monthly_stats_sent (chat_id, month_key) VALUES (?, ?)",
+                [(k, v) for k, v in monthly_stats_last_sent.items() if v],
+            )
+        except Exception as e:
+            print("Ошибка сохранения monthly_stats_sent (sqlite):", repr(e))
+
+if STORAGE_BACKEND == "sqlite":
+    store = SqliteHistoryStore(SQLITE_FILE)
+else:
+    store = JsonHistoryStore()
+
+# После сброса выгружаем чаты, которые evict пропустил из-за несброшенных записей
+write_buffer = WriteBehindBuffer(
+    store.flush_batch,
+    WRITE_BEHIND_MAX_DELAY_MS,
+    WRITE_BEHIND_MAX_PENDING,
+    after_flush=chat_messages.evict,
+    max_retries=WRITE_BEHIND_MAX_RETRIES,
+    failed_path=WRITE_BEHIND_FAILED_FILE,
+)
 
 # -----------------------------------------
 # START
@@ -235,34 +2241,23 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------------------------
 # СТАТИСТИКА: текущий календарный месяц
 # -----------------------------------------
-def _format_stats_for_period(
-    messages: list,
-    last_i: int,
-    period_start: datetime,
-    period_end: datetime
-) -> str:
-    period_msgs = []
-    for m in messages:
-        ts = m.get("timestamp")
-        if not ts:
-            continue
-        try:
-            dt = _parse_ts(ts)
-        except Exception:
-            continue
-        if period_start <= dt < period_end:
-            period_msgs.append(m)
-
-    if not period_msgs:
-        return "Нет данных за выбранный период."
-
+def _period_stats_from_columns(
+    cols: ChatColumns,
+    lo: int,
+    hi: int,
+    last_i: int
+) -> Dict[str, Any]:
+    """
+    Считает статистику по сообщениям [lo, hi) — границы периода
+    уже найдены бинарным поиском по колонке ts (json-бэкенд).
+    """
     user_msg_count = defaultdict(int)
     user_media_count = defaultdict(int)
     total_media = {"photo": 0, "video": 0, "voice": 0, "document": 0}
 
-    for msg in period_msgs:
-        t = msg.get("type", "text")
-        u = msg.get("username", "Аноним")
+    for i in range(lo, hi):
+        t = cols.msg_type(i)
+        u = cols.username(i)
         if t == "text":
             user_msg_count[u] += 1
         else:
@@ -270,22 +2265,27 @@ def _format_stats_for_period(
             if t in total_media:
                 total_media[t] += 1
 
-    new_msgs = []
     if last_i is None or last_i < 0:
         last_i = 0
+    new_lo = max(lo, last_i)
+    new_media = sum(1 for code in cols.types[new_lo:hi] if code != 0)
+
+    return {
+        "total": max(hi - lo, 0),
+        "new": max(hi - new_lo, 0),
+        "new_media": new_media,
+        "user_msg_count": dict(user_msg_count),
+        "user_media_count": dict(user_media_count),
+        "total_media": total_media,
+    }
 
-    for m in messages[last_i:]:
-        ts = m.get("timestamp")
-        if not ts:
-            continue
-        try:
-            dt = _parse_ts(ts)
-        except Exception:
-            continue
-        if period_start <= dt < period_end:
-            new_msgs.append(m)
-
-    new_media = sum(1 for m in new_msgs if m.get("type", "text") != "text")
+def _format_stats_for_period(
+    period_stats: Dict[str, Any],
+    period_start: datetime,
+    period_end: datetime
+) -> str:
+    if not period_stats["total"]:
+        return "Нет данных за выбранный период."
 
     title = (
         "📊 Статистика чата за период: "
@@ -297,39 +2297,44 @@ def _format_stats_for_period(
 
     text = (
         title
-        + f"Всего сообщений: {len(period_msgs)}\n"
-        + f"Новых сообщений с последней сводки: {len(new_msgs)}\n"
-        + f"Нового медиа: {new_media}\n\n"
+        + f"Всего сообщений: {period_stats['total']}\n"
+        + f"Новых сообщений с последней сводки: {period_stats['new']}\n"
+        + f"Нового медиа: {period_stats['new_media']}\n\n"
         + "🏆 Топ по сообщениям:\n"
     )
 
+    user_msg_count = period_stats["user_msg_count"]
     for i, (u, c) in enumerate(sorted(user_msg_count.items(), key=lambda x: x[1], reverse=True)[:15], 1):
         text += f"{i}. {u}: {c}\n"
 
     text += "\n🎞 Топ по медиа:\n"
+    user_media_count = period_stats["user_media_count"]
     for i, (u, c) in enumerate(sorted(user_media_count.items(), key=lambda x: x[1], reverse=True)[:15], 1):
         text += f"{i}. {u}: {c}\n"
 
     text += "\n🔎 Медиаконтент всего:\n"
-    for k, v in total_media.items():
+    for k, v in period_stats["total_media"].items():
         text += f"- {k}: {v}\n"
 
     return text
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    load_history()
-
     chat_id = str(update.effective_chat.id)
-    if not chat_messages.get(chat_id):
+    # Всё, что может досбрасывать буфер записи или читать диск, — в потоке, не в цикле событий
+    await asyncio.to_thread(store.refresh, chat_id)
+
+    # Пустоту проверяем по метаданным: count() поднял бы выгруженный чат целиком,
+    # а period_stats читает его снапшот через mmap
+    if not await asyncio.to_thread(store.has_new_messages, chat_id, 0):
         await update.message.reply_text("Нет данных.")
         return
 
-    messages = chat_messages[chat_id]
     now = _now_tz()
     start_m, end_m = _month_range_for(now)
     last_i = last_summary_index.get(chat_id, 0)
 
-    text = _format_stats_for_period(messages, last_i, start_m, end_m)
+    period_stats = await asyncio.to_thread(store.period_stats, chat_id, last_i, start_m, end_m)
+    text = _format_stats_for_period(period_stats, start_m, end_m)
     await update.message.reply_text(text)
 
 # -----------------------------------------
@@ -344,11 +2349,7 @@ async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Команда только для администраторов.")
         return
 
-    chat_messages[chat_id] = []
-    last_summary_index[chat_id] = 0
-    monthly_stats_last_sent[chat_id] = ""
-
-    save_message_immediately(chat_id)
+    await asyncio.to_thread(store.clear, chat_id)
     await update.message.reply_text("История очищена 🧹")
 
 # -----------------------------------------
@@ -391,28 +2392,86 @@ async def collect_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "username": username,
         "user_id": user.id,
         "text": text,
-        "timestamp": _now_tz().isoformat(),
+        "ts": int(_time.time()),
         "type": msg_type,
     }
 
-    chat_messages[chat_id].append(message_data)
-    save_message_immediately(chat_id)
+    store.append(chat_id, message_data)
 
-    if len(chat_messages[chat_id]) % 10 == 0:
-        save_history()
+# -----------------------------------------
+# ТОКЕНЫ: подключаемый офлайн-счётчик
+# -----------------------------------------
+# Служебные токены чата на каждое сообщение и на начало ответа (как считает OpenAI)
+_CHAT_TOKENS_PER_MESSAGE = 4
+_CHAT_TOKENS_REPLY = 3
+
+def _heuristic_token_count(text: str) -> int:
+    """
+    Оценка без токенизатора: ~3 символа на токен (кириллица, с запасом).
+    """
+    return len(text) // 3 + 1
+
+def _make_tiktoken_counter() -> Optional[Callable[[str], int]]:
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            encoding_name = tiktoken.encoding_name_for_model(SUMMARY_MODEL)
+        except (KeyError, AttributeError):
+            encoding_name = "o200k_base"
+        enc = tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        print("tiktoken недоступен, считаем токены эвристикой:", repr(e))
+        return None
+    print(f"tiktoken: кодировка {encoding_name} загружена")
+    return lambda text: len(enc.encode(text, disallowed_special=()))
+
+_token_counters: Dict[str, Callable[[str], int]] = {"heuristic": _heuristic_token_count}
+
+def register_token_counter(name: str, counter: Callable[[str], int]) -> None:
+    """
+    Подключить свой счётчик токенов (например, под другую модель).
+    """
+    _token_counters[name] = counter
+
+def _select_token_counter() -> Tuple[str, Callable[[str], int]]:
+    # tiktoken здесь не трогаем: get_encoding может пойти в сеть (см. warm_token_counter)
+    if TOKENIZER in _token_counters:
+        return TOKENIZER, _token_counters[TOKENIZER]
+    return "heuristic", _heuristic_token_count
+
+TOKEN_COUNTER_NAME, _count_tokens = _select_token_counter()
+
+def warm_token_counter() -> None:
+    """
+    Загружает кодировку tiktoken и переключает на неё count_tokens. Вызывается из потока после старта.
+    """
+    global TOKEN_COUNTER_NAME, _count_tokens
+    if TOKENIZER not in ("auto", "tiktoken"):
+        return
+    counter = _make_tiktoken_counter()
+    if counter is not None:
+        register_token_counter("tiktoken", counter)
+        TOKEN_COUNTER_NAME, _count_tokens = "tiktoken", counter
+
+def count_tokens(text: str) -> int:
+    return _count_tokens(text)
+
+def count_chat_tokens(system_msg: str, prompt: str) -> int:
+    """
+    Токены запроса chat.completions целиком: оба сообщения + служебные токены.
+    """
+    return (
+        count_tokens(system_msg)
+        + count_tokens(prompt)
+        + 2 * _CHAT_TOKENS_PER_MESSAGE
+        + _CHAT_TOKENS_REPLY
+    )
 
 # -----------------------------------------
 # ПРОМПТ СВОДКИ (стендап-режим)
 # -----------------------------------------
-def generate_summary_prompt(messages: list) -> str:
-    raw = ""
-    for m in messages:
-        text = m.get("text", "")
-        if len(text) > MAX_TEXT_LENGTH_PER_MESSAGE:
-            text = text[:MAX_TEXT_LENGTH_PER_MESSAGE] + "..."
-        raw += f"{m.get('username', 'Аноним')}: {text}\n"
-
-    return f"""Ты — стендап-комик и хроникёр чата одновременно: добрый, остроумный, ироничный.
+SUMMARY_PROMPT_RULES = """Ты — стендап-комик и хроникёр чата одновременно: добрый, остроумный, ироничный.
 Твоя задача — сделать сводку, которую реально смешно и приятно читать.
 
 КЛЮЧЕВОЕ:
@@ -446,12 +2505,141 @@ def generate_summary_prompt(messages: list) -> str:
 → пересказывай спокойно, нейтрально, без шуток и иронии
 → без панчей, без ремарок в скобках, без "стендап-подачи"
 
-Вот сообщения чата:
+"""
+
+SUMMARY_PROMPT_FINAL = "Сделай сводку: смешно, живо, бережно, без выдумывания фактов.\n"
+
+def _format_message_line(m: Dict[str, Any], max_len: int = MAX_TEXT_LENGTH_PER_MESSAGE) -> str:
+    text = m.get("text", "")
+    if len(text) > max_len:
+        text = text[:max_len] + "..."
+    return f"{m.get('username', 'Аноним')}: {text}\n"
+
+def _summary_prompt_parts(lines: Iterable[str], digest_text: Optional[str] = None) -> Iterator[str]:
+    yield SUMMARY_PROMPT_RULES
+    if digest_text:
+        yield "Начало переписки уже законспектировано (цитаты в конспекте — дословные):\n"
+        yield digest_text
+        yield "\n\nВот последние сообщения чата после конспекта:\n"
+    else:
+        yield "Вот сообщения чата:\n"
+    yield from lines
+    yield "\n\n"
+    yield SUMMARY_PROMPT_FINAL
+
+def generate_summary_prompt(messages: list, max_len: int = MAX_TEXT_LENGTH_PER_MESSAGE) -> str:
+    # Куски склеиваются за один проход, без raw += ... в цикле
+    lines = (_format_message_line(m, max_len) for m in messages)
+    return "".join(_summary_prompt_parts(lines))
+
+# -----------------------------------------
+# ПРОМПТ ПОД БЮДЖЕТ ТОКЕНОВ
+# Порядок ужатия, пока промпт не влезет в бюджет:
+# 1) как есть (MAX_TEXT_LENGTH_PER_MESSAGE на сообщение);
+# 2) без пустых строк медиа без подписи (они есть в строке "Также было прислано");
+# 3) всё более короткий лимит на сообщение — режутся только самые длинные.
+# Если не влезло и так — промпта нет, сводка идёт через map-reduce.
+# -----------------------------------------
+PROMPT_TRIM_LIMITS = (300, 150, 80)
+
+def fit_summary_prompt(
+    messages: list,
+    budget: int,
+    digest_text: Optional[str] = None,
+) -> Tuple[Optional[str], int, str]:
+    """
+    Возвращает (prompt, tokens, strategy). prompt=None — не влезает даже после ужатия,
+    tokens тогда — размер полного промпта. digest_text — скользящий конспект начала бэклога.
+    """
+    overhead = count_chat_tokens(SUMMARY_SYSTEM_MSG, "".join(_summary_prompt_parts((), digest_text)))
+    with_text = [m for m in messages if m.get("text")]
+
+    steps = [("full", messages, MAX_TEXT_LENGTH_PER_MESSAGE)]
+    if len(with_text) < len(messages):
+        steps.append(("drop-empty-media", with_text, MAX_TEXT_LENGTH_PER_MESSAGE))
+    for limit in PROMPT_TRIM_LIMITS:
+        if limit < MAX_TEXT_LENGTH_PER_MESSAGE:
+            steps.append((f"trim-{limit}", with_text, limit))
+
+    full_tokens = None
+    for strategy, msgs, limit in steps:
+        lines = [_format_message_line(m, limit) for m in msgs]
+        est = overhead + sum(count_tokens(line) for line in lines)
+        if full_tokens is None:
+            full_tokens = est
+        if est > budget:
+            continue
+        prompt = "".join(_summary_prompt_parts(lines, digest_text))
+        tokens = count_chat_tokens(SUMMARY_SYSTEM_MSG, prompt)
+        if tokens <= budget:
+            return prompt, tokens, strategy
+
+    return None, full_tokens or overhead, "map-reduce"
+
+# -----------------------------------------
+# ПРОМПТЫ MAP-REDUCE (большой бэклог)
+# -----------------------------------------
+def generate_chunk_prompt(messages: list, part: int, parts: int) -> str:
+    """
+    Map-шаг: фактический конспект одного фрагмента переписки.
+    """
+    raw = "".join(_format_message_line(m) for m in messages)
+
+    return f"""Это фрагмент {part} из {parts} переписки чата (по порядку).
+Сделай подробный фактический конспект фрагмента — он пойдёт в итоговую сводку.
+
+ПРАВИЛА:
+- Перечисли все темы, которые обсуждались: кто участвовал, что произошло, чем закончилось.
+- Имена пользователей копируй строго как в сообщениях, символ в символ.
+- Для ярких моментов сохрани 1–2 короткие дословные цитаты.
+- Отмечай, если тема грустная или чувствительная.
+- Без шуток и оценок, ничего не выдумывай.
+
+Сообщения:
 {raw}
+"""
+
+def generate_notes_merge_prompt(notes: list) -> str:
+    """
+    Промежуточный reduce-шаг: сжимает несколько конспектов в один, без потери тем.
+    """
+    joined = "\n\n".join(f"--- Конспект {i} ---\n{n}" for i, n in enumerate(notes, 1))
+    return f"""Ниже конспекты последовательных фрагментов переписки чата.
+Объедини их в один фактический конспект в хронологическом порядке.
+Сохрани все темы, участников (имена символ в символ), цитаты и пометки о чувствительных темах.
+Без шуток и оценок, ничего не выдумывай.
+
+{joined}
+"""
+
+def generate_digest_update_prompt(digest_text: Optional[str], messages: list) -> str:
+    """
+    Скользящий конспект: дописывает к прошлому конспекту новые сообщения.
+    """
+    raw = "".join(_format_message_line(m) for m in messages)
+    previous = digest_text or "(пока пусто)"
+    return f"""Ты ведёшь фактический конспект переписки чата, который потом станет сводкой.
+Вот текущий конспект:
+{previous}
 
-Сделай сводку: смешно, живо, бережно, без выдумывания фактов.
+Вот новые сообщения после него:
+{raw}
+Перепиши конспект целиком с учётом новых сообщений, в хронологическом порядке.
+Сохрани все темы, участников (имена символ в символ), 1–2 короткие дословные цитаты на яркие моменты
+и пометки о грустных/чувствительных темах. Без шуток и оценок, ничего не выдумывай.
 """
 
+def generate_merge_prompt(notes: list) -> str:
+    """
+    Финальный reduce-шаг: сводка в обычном стендап-формате по конспектам фрагментов.
+    """
+    joined = "\n\n".join(f"--- Фрагмент {i} ---\n{n}" for i, n in enumerate(notes, 1))
+    return f"""{SUMMARY_PROMPT_RULES}Переписка была длинной, поэтому вот конспекты её фрагментов по порядку
+(цитаты в них — дословные сообщения участников):
+{joined}
+
+{SUMMARY_PROMPT_FINAL}"""
+
 # -----------------------------------------
 # МЕДИА СТРОКА
 # -----------------------------------------
@@ -470,13 +2658,453 @@ def _media_summary_line(media_counts: Dict[str, int]) -> str:
         return ""
     return "\n\n🔎 Также было прислано: " + ", ".join(parts)
 
+# -----------------------------------------
+# НАРЕЗКА НА ФРАГМЕНТЫ
+# -----------------------------------------
+def _split_into_chunks(messages: list, max_tokens: int) -> list:
+    """
+    Режет сообщения на последовательные фрагменты не больше max_tokens
+    и не больше MAX_MESSAGES_FOR_ANALYSIS сообщений каждый.
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+    for m in messages:
+        t = count_tokens(_format_message_line(m))
+        if current and (current_tokens + t > max_tokens or len(current) >= MAX_MESSAGES_FOR_ANALYSIS):
+            chunks.append(current)
+            current = []
+            current_tokens = 0
+        current.append(m)
+        current_tokens += t
+    if current:
+        chunks.append(current)
+    return chunks
+
+# -----------------------------------------
+# OPENAI: предохранитель (circuit breaker)
+# closed    — запросы идут как обычно, считаем ошибки соединения и 5xx подряд
+# open      — запросы сразу падают с OpenAIUnavailable, фоновая проба ждёт своего времени
+# half-open — идёт проба; успех закрывает предохранитель, неудача снова открывает
+# -----------------------------------------
+class OpenAIUnavailable(APIConnectionError):
+    """
+    Предохранитель открыт. Наследник APIConnectionError — для вызывающих это та же сетевая ошибка.
+    """
+    def __init__(self, retry_in: float):
+        super().__init__(
+            message=f"OpenAI недоступен (предохранитель открыт), проверка через {retry_in:.0f}s",
+            request=httpx.Request("POST", f"{client.base_url}chat/completions"),
+        )
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        probe: Callable[[], Any],
+        threshold: int,
+        cooldown: float,
+        max_cooldown: float,
+    ):
+        self.probe = probe
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.max_cooldown = max(cooldown, max_cooldown)
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.next_probe_at = 0.0
+        self.fast_failed = 0
+        self._current_cooldown = cooldown
+        self._probe_task: Optional[asyncio.Task] = None
+
+    def check(self) -> None:
+        if self.state == "closed":
+            return
+        self.fast_failed += 1
+        raise OpenAIUnavailable(max(0.0, self.next_probe_at - _time.monotonic()))
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == "closed" and self.failures >= self.threshold:
+            self._open()
+
+    def _open(self) -> None:
+        self.state = "open"
+        self.opened_at = _time.monotonic()
+        self.fast_failed = 0
+        self._current_cooldown = self.cooldown
+        self.next_probe_at = self.opened_at + self._current_cooldown
+        print(f"OpenAI: предохранитель открыт после {self.failures} ошибок соединения/5xx подряд")
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.ensure_future(self._probe_loop())
+
+    async def _probe_loop(self) -> None:
+        while self.state != "closed":
+            await asyncio.sleep(max(0.0, self.next_probe_at - _time.monotonic()))
+            self.state = "half-open"
+            try:
+                await self.probe()
+            except APIConnectionError as e:
+                self.state = "open"
+                self._current_cooldown = min(self.max_cooldown, self._current_cooldown * 2)
+                self.next_probe_at = _time.monotonic() + self._current_cooldown
+                print(f"OpenAI: проба не прошла ({e!r}), следующая через {self._current_cooldown:.0f}s")
+                continue
+            except Exception as e:
+                # Ответ с ошибкой (401, 404, ...) — но сеть до OpenAI есть
+                print(f"OpenAI: проба ответила ошибкой {e!r} — сеть есть")
+
+            self.state = "closed"
+            self.failures = 0
+            print(
+                f"OpenAI: предохранитель закрыт через {_time.monotonic() - self.opened_at:.0f}s, "
+                f"быстрых отказов за это время: {self.fast_failed}"
+            )
+
+    def describe(self) -> str:
+        if self.state == "closed":
+            return f"closed (сетевых ошибок подряд: {self.failures}/{self.threshold})"
+        left = max(0.0, self.next_probe_at - _time.monotonic())
+        return f"{self.state} {_time.monotonic() - self.opened_at:.0f}s, проба через {left:.0f}s"
+
+    async def stop(self) -> None:
+        if self._probe_task is not None and not self._probe_task.done():
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+
+async def _openai_probe() -> None:
+    # Дешёвый запрос без токенов: проверяет DNS, TCP, TLS и прокси — весь путь до API
+    await client.models.retrieve(SUMMARY_MODEL, timeout=OPENAI_CONNECT_TIMEOUT + 5)
+
+openai_breaker = CircuitBreaker(
+    _openai_probe,
+    OPENAI_BREAKER_THRESHOLD,
+    OPENAI_BREAKER_COOLDOWN,
+    OPENAI_BREAKER_MAX_COOLDOWN,
+)
+
+# -----------------------------------------
+# OPENAI: лимиты запросов и токенов в минуту (token bucket) с приоритетами
+# -----------------------------------------
+PRIORITY_INTERACTIVE = 0  # /whatsnew
+PRIORITY_BATCH = 1        # автосводка, скользящий конспект
+
+# Приоритет запросов текущей задачи (наследуется задачами, созданными из неё)
+openai_priority: contextvars.ContextVar[int] = contextvars.ContextVar("openai_priority", default=PRIORITY_BATCH)
+
+class RateLimiter:
+    """
+    Два ведра: запросы (ёмкость rpm) и токены (ёмкость tpm), пополняются равномерно.
+    Ждущие стоят в очереди по (приоритет, порядок прихода); ведро берёт только голова очереди,
+    поэтому пришедший /whatsnew обгоняет уже ждущие автосводки.
+    """
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = _time.monotonic()
+        self._queue: list = []
+        self._seq = itertools.count()
+        self._cond: Optional[asyncio.Condition] = None
+        self.waited_total = 0.0
+        self.waited_max = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rpm > 0 or self.tpm > 0
+
+    def _refill(self) -> None:
+        now = _time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm > 0:
+            self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60)
+        if self.tpm > 0:
+            self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60)
+
+    def _wait_needed(self, tokens: int) -> float:
+        wait = 0.0
+        if self.rpm > 0 and self._requests < 1:
+            wait = (1 - self._requests) * 60 / self.rpm
+        if self.tpm > 0 and self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens) * 60 / self.tpm)
+        return wait
+
+    async def acquire(self, tokens: int, priority: int = PRIORITY_BATCH) -> Tuple[float, int]:
+        """
+        Ждёт бюджет на один запрос в tokens токенов.
+        Возвращает (время ожидания в сек, сколько токенов списано) — refund считать от списанного.
+        """
+        if not self.enabled:
+            return 0.0, 0
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        # Запрос больше ёмкости всё равно должен пройти: списываем не больше tpm
+        tokens = min(tokens, self.tpm) if self.tpm > 0 else 0
+
+        started = _time.monotonic()
+        entry = (priority, next(self._seq))
+        async with self._cond:
+            heapq.heappush(self._queue, entry)
+            self._cond.notify_all()  # голова очереди могла смениться
+            try:
+                while True:
+                    timeout = None
+                    if self._queue[0] == entry:
+                        self._refill()
+                        timeout = self._wait_needed(tokens)
+                        if timeout <= 0:
+                            break
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+                raise
+
+            heapq.heappop(self._queue)
+            self._requests -= 1 if self.rpm > 0 else 0
+            self._tokens -= tokens
+            self._cond.notify_all()
+
+        waited = _time.monotonic() - started
+        self.waited_total += waited
+        self.waited_max = max(self.waited_max, waited)
+        return waited, tokens
+
+    def refund(self, tokens: int) -> None:
+        """
+        Возвращает в бюджет токены, оценённые с запасом (max_tokens больше фактического ответа).
+        """
+        if self.tpm > 0 and tokens > 0:
+            self._refill()
+            self._tokens = min(float(self.tpm), self._tokens + tokens)
+
+    def describe(self) -> str:
+        if not self.enabled:
+            return "выключен"
+        self._refill()
+        return (
+            f"запросов {self._requests:.0f}/{self.rpm}, токенов {self._tokens:.0f}/{self.tpm}, "
+            f"в очереди {len(self._queue)}, ожидание max {self.waited_max:.1f}s"
+        )
+
+openai_limiter = RateLimiter(OPENAI_RPM, OPENAI_TPM)
+
 # -----------------------------------------
 # СВОДКА: генерация через OpenAI + расширенные репорты
 # -----------------------------------------
-async def _build_summary_from_new_messages(all_new_messages: list) -> Tuple[Optional[str], Dict[str, int], Optional[str]]:
+SUMMARY_SYSTEM_MSG = (
+    "Ты — стендап-хроникёр чата: добрый, ироничный, наблюдательный. "
+    "КРИТИЧНО важно: имена пользователей копируй строго как они написаны, "
+    "символ в символ, без любых изменений и без перевода/транслита/склонения/смены регистра. "
+    "Если тема тяжёлая/чувствительная — мгновенно переходи на нейтральный тон без шуток."
+)
+
+NOTES_SYSTEM_MSG = (
+    "Ты — аккуратный конспектист переписки чата. Пишешь кратко и по фактам. "
+    "Имена пользователей копируешь строго символ в символ."
+)
+
+# Бюджет текущей сводки: {"deadline", "attempts", "retries"}.
+# Общий для всех запросов сводки (map-reduce через gather наследует контекст).
+_summary_budget: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "summary_budget", default=None
+)
+
+def _new_summary_budget() -> Dict[str, float]:
+    return {"deadline": _time.monotonic() + SUMMARY_DEADLINE, "attempts": 0, "retries": 0}
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, APIConnectionError):
+        return True  # включая APITimeoutError
+    if isinstance(e, APIStatusError):
+        if e.status_code == 429 and getattr(e, "code", None) == "insufficient_quota":
+            return False  # кончились деньги — повтор не поможет
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return False
+
+def _retry_after(e: Exception) -> Optional[float]:
+    """
+    Retry-After из ответа OpenAI (retry-after-ms, retry-after в секундах или HTTP-дата).
+    """
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return email.utils.parsedate_to_datetime(value).timestamp() - _time.time()
+    except (TypeError, ValueError):
+        return None
+
+def _retry_delay(e: Exception, attempt: int) -> float:
+    delay = random.uniform(0, min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+    retry_after = _retry_after(e)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+async def _chat_completion(system_msg: str, prompt: str, label: str = "summary", **params) -> str:
+    prompt_tokens = count_chat_tokens(system_msg, prompt)
+    print(
+        f"OpenAI [{label}]: промпт {prompt_tokens} токенов "
+        f"({TOKEN_COUNTER_NAME}), max_tokens={params.get('max_tokens')}"
+    )
+    estimate = prompt_tokens + int(params.get("max_tokens") or 0)
+    budget = _summary_budget.get()
+    if budget is None:
+        budget = _new_summary_budget()
+
+    attempt = 0
+    while True:
+        openai_breaker.check()
+        attempt += 1
+        budget["attempts"] += 1
+        waited, charged = await asyncio.wait_for(
+            openai_limiter.acquire(estimate, openai_priority.get()),
+            max(0.0, budget["deadline"] - _time.monotonic()),
+        )
+        if waited >= 1:
+            print(f"OpenAI [{label}]: ждали лимит RPM/TPM {waited:.1f}s")
+        left = budget["deadline"] - _time.monotonic()
+        try:
+            response = await client.chat.completions.create(
+                model=SUMMARY_MODEL,
+                messages=[
+                    {"role": "system", "content": system_msg},
+                    {"role": "user", "content": prompt},
+                ],
+                timeout=httpx.Timeout(max(1.0, min(OPENAI_TIMEOUT, left)), connect=OPENAI_CONNECT_TIMEOUT),
+                **params,
+            )
+            openai_breaker.record_success()
+            break
+        except Exception as e:
+            if isinstance(e, APITimeoutError):
+                # Долгий ответ (большой промпт) — не недоступность; не дождались соединения — она
+                if isinstance(e.__cause__, httpx.ConnectTimeout):
+                    openai_breaker.record_failure()
+            elif isinstance(e, APIConnectionError):
+                openai_breaker.record_failure()
+            elif isinstance(e, APIStatusError):
+                if e.status_code >= 500:
+                    openai_breaker.record_failure()
+                else:
+                    openai_breaker.record_success()  # OpenAI ответил — сеть есть
+            if not _retryable(e) or attempt >= OPENAI_RETRY_MAX_ATTEMPTS:
+                raise
+            delay = _retry_delay(e, attempt)
+            if _time.monotonic() + delay >= budget["deadline"]:
+                print(f"OpenAI [{label}]: повтор через {delay:.1f}s не укладывается в SUMMARY_DEADLINE")
+                raise
+            budget["retries"] += 1
+            print(f"OpenAI [{label}]: попытка {attempt}/{OPENAI_RETRY_MAX_ATTEMPTS} не удалась ({e!r}), повтор через {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        print(f"OpenAI [{label}]: usage prompt={usage.prompt_tokens} completion={usage.completion_tokens}")
+        openai_limiter.refund(charged - usage.prompt_tokens - usage.completion_tokens)
+    return response.choices[0].message.content
+
+async def _map_reduce_summary(
+    messages: list,
+    stats: Dict[str, int],
+    digest_text: Optional[str] = None,
+) -> str:
+    """
+    Иерархическая сводка большого бэклога:
+    1) map: фрагменты по SUMMARY_CHUNK_TOKENS конспектируются параллельно;
+    2) reduce: если конспекты всё ещё не влезают в бюджет — сжимаем их группами;
+    3) финальная сводка в стендап-формате по конспектам.
+    """
+    sem = asyncio.Semaphore(max(1, SUMMARY_MAP_CONCURRENCY))
+
+    async def _notes(prompt: str, label: str) -> str:
+        async with sem:
+            return await _chat_completion(NOTES_SYSTEM_MSG, prompt, label=label, temperature=0.3, max_tokens=1500)
+
+    async def _all_notes(jobs: list) -> list:
+        # Первая ошибка отменяет остальные фрагменты: сводка всё равно не соберётся,
+        # а недоделанные вызовы только тратили бы лимиты OpenAI
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tasks = [tg.create_task(_notes(prompt, label)) for prompt, label in jobs]
+        except ExceptionGroup as eg:
+            raise eg.exceptions[0]
+        return [t.result() for t in tasks]
+
+    chunks = _split_into_chunks(messages, SUMMARY_CHUNK_TOKENS)
+    stats["chunks"] = len(chunks)
+    notes = await _all_notes(
+        [(generate_chunk_prompt(chunk, i, len(chunks)), f"map {i}/{len(chunks)}") for i, chunk in enumerate(chunks, 1)]
+    )
+    if digest_text:
+        # Скользящий конспект — уже готовый конспект самого начала бэклога
+        notes = [digest_text] + list(notes)
+
+    while len(notes) > 1 and count_tokens(generate_merge_prompt(notes)) > SUMMARY_PROMPT_TOKEN_BUDGET:
+        groups = []
+        current = []
+        current_tokens = 0
+        for n in notes:
+            t = count_tokens(n)
+            if current and current_tokens + t > SUMMARY_CHUNK_TOKENS:
+                groups.append(current)
+                current = []
+                current_tokens = 0
+            current.append(n)
+            current_tokens += t
+        groups.append(current)
+
+        if len(groups) == len(notes):
+            # Каждый конспект сам по себе больше фрагмента — сжимаем попарно
+            groups = [notes[i:i + 2] for i in range(0, len(notes), 2)]
+
+        notes = await _all_notes([(generate_notes_merge_prompt(g), "reduce") for g in groups])
+        stats["reduce_rounds"] = stats.get("reduce_rounds", 0) + 1
+
+    return await _chat_completion(
+        SUMMARY_SYSTEM_MSG,
+        generate_merge_prompt(notes),
+        label="merge",
+        temperature=1.05,
+        presence_penalty=0.45,
+        frequency_penalty=0.2,
+        max_tokens=3000,
+    )
+
+async def _build_summary_from_new_messages(
+    all_new_messages: list,
+    digest: Optional[Dict[str, Any]] = None,
+) -> Tuple[Optional[str], Dict[str, int], Optional[str]]:
     """
     Возвращает (summary, media_counts, error_id)
 
+    digest — скользящий конспект начала бэклога (см. rolling_digest_job):
+    тогда в модель уходит конспект + только хвост после него.
+
+    Промпт подгоняется под SUMMARY_PROMPT_TOKEN_BUDGET до отправки (fit_summary_prompt).
+    Если не влезает и после ужатия — сразу map-reduce,
+    без заведомо неудачного основного запроса и без отбрасывания старых сообщений.
+
     error_id может иметь префикс:
     - "NETWORK:xxxx" — если это сетевой доступ до OpenAI
     - "xxxx" — прочие ошибки
@@ -487,30 +3115,33 @@ async def _build_summary_from_new_messages(all_new_messages: list) -> Tuple[Opti
         if t in media_counts:
             media_counts[t] += 1
 
+    digest_text = None
     new = all_new_messages
-    prompt = generate_summary_prompt(new)
+    if digest:
+        digest_text = digest["text"]
+        new = all_new_messages[digest["upto"] - digest["from"]:]
 
-    system_msg = (
-        "Ты — стендап-хроникёр чата: добрый, ироничный, наблюдательный. "
-        "КРИТИЧНО важно: имена пользователей копируй строго как они написаны, "
-        "символ в символ, без любых изменений и без перевода/транслита/склонения/смены регистра. "
-        "Если тема тяжёлая/чувствительная — мгновенно переходи на нейтральный тон без шуток."
-    )
+    prompt, prompt_tokens, strategy = fit_summary_prompt(new, SUMMARY_PROMPT_TOKEN_BUDGET, digest_text)
+    mode = "primary" if prompt is not None else "map-reduce"
+    mr_stats: Dict[str, int] = {}
+    budget = _new_summary_budget()
+    budget_token = _summary_budget.set(budget)
 
-    # --- Primary
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_msg},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=1.05,
-            presence_penalty=0.45,
-            frequency_penalty=0.2,
-            max_tokens=3000,
-        )
-        summary = response.choices[0].message.content
+        if mode == "primary":
+            if strategy != "full":
+                print(f"Сводка: промпт ужат ({strategy}) до {prompt_tokens} токенов")
+            summary = await _chat_completion(
+                SUMMARY_SYSTEM_MSG,
+                prompt,
+                temperature=1.05,
+                presence_penalty=0.45,
+                frequency_penalty=0.2,
+                max_tokens=3000,
+            )
+        else:
+            print(f"Сводка: {prompt_tokens} токенов > {SUMMARY_PROMPT_TOKEN_BUDGET}, режим map-reduce")
+            summary = await _map_reduce_summary(new, mr_stats, digest_text)
         return summary, media_counts, None
 
     except APIConnectionError as e:
@@ -518,13 +3149,22 @@ async def _build_summary_from_new_messages(all_new_messages: list) -> Tuple[Opti
         error_id = uuid.uuid4().hex[:8]
         log_error(
             error_id=error_id,
-            where="openai.chat.completions.create (connection)",
+            where=f"openai.chat.completions.create ({mode}, connection)",
             exc=e,
             extra={
                 "type": "connection",
-                "model": "gpt-4o-mini",
+                "model": SUMMARY_MODEL,
+                "mode": mode,
                 "messages_total": len(all_new_messages),
                 "used_messages": len(new),
+                "digest": bool(digest_text),
+                "prompt_tokens": prompt_tokens,
+                "prompt_strategy": strategy,
+                "tokenizer": TOKEN_COUNTER_NAME,
+                **mr_stats,
+                "attempts": budget["attempts"],
+                "retries": budget["retries"],
+                "deadline_s": SUMMARY_DEADLINE,
                 "data_dir": DATA_DIR,
             },
         )
@@ -534,121 +3174,488 @@ async def _build_summary_from_new_messages(all_new_messages: list) -> Tuple[Opti
         error_id = uuid.uuid4().hex[:8]
         log_error(
             error_id=error_id,
-            where="openai.chat.completions.create (primary)",
+            where=f"openai.chat.completions.create ({mode})",
             exc=e,
             extra={
                 "type": "other",
-                "model": "gpt-4o-mini",
+                "model": SUMMARY_MODEL,
+                "mode": mode,
                 "messages_total": len(all_new_messages),
                 "used_messages": len(new),
+                "digest": bool(digest_text),
+                "prompt_tokens": prompt_tokens,
+                "prompt_strategy": strategy,
+                "tokenizer": TOKEN_COUNTER_NAME,
+                **mr_stats,
+                "attempts": budget["attempts"],
+                "retries": budget["retries"],
+                "deadline_s": SUMMARY_DEADLINE,
                 "data_dir": DATA_DIR,
             },
         )
+        return None, media_counts, error_id
+
+    finally:
+        _summary_budget.reset(budget_token)
+
+# -----------------------------------------
+# СКОЛЬЗЯЩИЙ КОНСПЕКТ (фон)
+# -----------------------------------------
+def _valid_digest(chat_id: str, last_i: int, total: int) -> Optional[Dict[str, Any]]:
+    """
+    Конспект годится, только если он начинается ровно с last_summary_index.
+    """
+    digest = running_digest.get(chat_id)
+    if not digest or digest.get("from") != last_i or not (last_i < digest.get("upto", 0) <= total):
+        return None
+    return digest
+
+async def _update_digest(chat_id: str) -> bool:
+    last_i = last_summary_index.get(chat_id, 0)
+    if not await asyncio.to_thread(store.has_new_messages, chat_id, last_i, ROLLING_DIGEST_EVERY):
+        return False
+    total = await asyncio.to_thread(store.count, chat_id)
+    digest = _valid_digest(chat_id, last_i, total)
+    start = digest["upto"] if digest else last_i
+
+    if total - start < ROLLING_DIGEST_EVERY:
+        return False
+
+    text = digest["text"] if digest else None
+    tail = (await asyncio.to_thread(store.messages_from, chat_id, start))[:total - start]
+    for i, chunk in enumerate(_split_into_chunks(tail, SUMMARY_CHUNK_TOKENS), 1):
+        text = await _chat_completion(
+            NOTES_SYSTEM_MSG,
+            generate_digest_update_prompt(text, chunk),
+            label=f"digest {chat_id} #{i}",
+            temperature=0.3,
+            max_tokens=2000,
+        )
+
+    # Пока конспект писался, могла выйти сводка — тогда он уже не нужен
+    if last_summary_index.get(chat_id, 0) != last_i:
+        return False
+
+    await asyncio.to_thread(store.set_digest, chat_id, {"from": last_i, "upto": total, "text": text})
+    return True
+
+async def rolling_digest_job(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(store.refresh)
+
+    async def _run_chat(chat_id: str) -> bool:
+        try:
+            return await _update_digest(chat_id)
+        except Exception as e:
+            error_id = uuid.uuid4().hex[:8]
+            log_error(error_id, "rolling_digest_job", e, {"chat_id": chat_id})
+            return False
+
+    updated = await asyncio.gather(
+        *(
+            task_queue.submit(PRIORITY_BATCH, f"digest {chat_id}", functools.partial(_run_chat, chat_id))
+            for chat_id in await asyncio.to_thread(store.chat_ids)
+        )
+    )
+    if any(updated):
+        print(f"rolling_digest: обновлено конспектов: {sum(updated)}")
+
+# -----------------------------------------
+# СНАПШОТЫ: периодическое сворачивание журналов
+# -----------------------------------------
+async def snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    started = _time.monotonic()
+    try:
+        done = await asyncio.to_thread(store.snapshot)
+    except Exception as e:
+        error_id = uuid.uuid4().hex[:8]
+        log_error(error_id, "snapshot_job", e)
+        return
+    if done:
+        print(f"snapshot: {done} за {_time.monotonic() - started:.1f}s")
 
-        # fallback: последние MAX_MESSAGES_FOR_ANALYSIS сообщений
-        if len(all_new_messages) > MAX_MESSAGES_FOR_ANALYSIS:
-            new = all_new_messages[-MAX_MESSAGES_FOR_ANALYSIS:]
-            prompt = generate_summary_prompt(new)
+# -----------------------------------------
+# ПОЛИТИКА ХРАНЕНИЯ: фоновая очистка старых сообщений
+# -----------------------------------------
+async def retention_job(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(store.refresh)
+    now_ts = int(_time.time())
+    started = _time.monotonic()
+    dropped = 0
+
+    for chat_id in await asyncio.to_thread(store.chat_ids):
+        try:
+            # Подъём чата, перебор удаляемых сообщений и запись снапшота — не в цикле событий
+            dropped += await asyncio.to_thread(store.compact, chat_id, now_ts)
+        except Exception as e:
+            error_id = uuid.uuid4().hex[:8]
+            log_error(error_id, "retention_job", e, {"chat_id": chat_id})
+
+    if dropped:
+        print(f"retention: удалено {dropped} старых сообщений за {_time.monotonic() - started:.1f}s")
+
+# -----------------------------------------
+# ОЧЕРЕДЬ ЗАДАЧ: приоритеты + воркеры
+# Задача — фабрика корутины. Воркер берёт задачу с наименьшим (приоритет, порядок прихода)
+# и выполняет её с этим приоритетом и для лимитов OpenAI (openai_priority).
+# Уже начатые задачи не прерываются: приоритет решает, кто следующий.
+# -----------------------------------------
+_PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BATCH: "batch"}
+
+class PriorityTaskQueue:
+    def __init__(self, workers: int, interactive_workers: int):
+        self.workers = max(1, workers)
+        self.interactive_workers = max(0, interactive_workers)
+        self._heap: list = []
+        self._seq = itertools.count()
+        # Будит ждущих воркеров: событие заменяется новым и взводится (см. _wake)
+        self._changed: Optional[asyncio.Event] = None
+        self._tasks: list = []
+        self._stopping = False
+        self.running: Dict[int, int] = defaultdict(int)
+        self.done: Dict[int, int] = defaultdict(int)
+        self.wait_total: Dict[int, float] = defaultdict(float)
+        self.wait_max: Dict[int, float] = defaultdict(float)
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._changed = asyncio.Event()
+        self._tasks = [
+            asyncio.ensure_future(self._worker(i, interactive_only=i >= self.workers))
+            for i in range(self.workers + self.interactive_workers)
+        ]
+
+    async def stop(self) -> None:
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for *_, fut in self._heap:
+            fut.cancel()
+        self._heap.clear()
+
+    def submit(self, priority: int, label: str, factory: Callable[[], Any]) -> "asyncio.Future":
+        """
+        Ставит задачу в очередь и сразу возвращает future с её результатом.
+        """
+        self.start()
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), _time.monotonic(), label, factory, fut))
+        self._wake()
+        return fut
+
+    def _wake(self) -> None:
+        # Синхронно, без отдельной задачи: все, кто ждал старое событие, перепроверят очередь
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _can_take(self, interactive_only: bool) -> bool:
+        return bool(self._heap) and (not interactive_only or self._heap[0][0] == PRIORITY_INTERACTIVE)
+
+    async def _worker(self, n: int, interactive_only: bool) -> None:
+        while True:
+            while not self._can_take(interactive_only):
+                await self._changed.wait()
+            priority, _, enqueued, label, factory, fut = heapq.heappop(self._heap)
+            if self._heap:
+                self._wake()  # голова очереди сменилась — интерактивному воркеру может найтись задача
+            if fut.done():
+                continue  # ждущий отменил задачу, пока она стояла в очереди
+
+            waited = _time.monotonic() - enqueued
+            self.wait_total[priority] += waited
+            self.wait_max[priority] = max(self.wait_max[priority], waited)
+            if waited >= 5:
+                print(f"Очередь: {label} ждал {waited:.1f}s (воркер {n})")
+
+            self.running[priority] += 1
+            priority_token = openai_priority.set(priority)
             try:
-                response = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": system_msg},
-                        {"role": "user", "content": prompt},
-                    ],
-                    temperature=1.0,
-                    max_tokens=3000,
-                )
-                summary = response.choices[0].message.content
-                return summary, media_counts, None
-
-            except APIConnectionError as e2:
-                error_id2 = uuid.uuid4().hex[:8]
-                log_error(
-                    error_id=error_id2,
-                    where="openai.chat.completions.create (fallback connection)",
-                    exc=e2,
-                    extra={
-                        "type": "connection",
-                        "model": "gpt-4o-mini",
-                        "messages_total": len(all_new_messages),
-                        "used_messages": len(new),
-                        "data_dir": DATA_DIR,
-                    },
-                )
-                return None, media_counts, f"NETWORK:{error_id2}"
-
-            except Exception as e2:
-                error_id2 = uuid.uuid4().hex[:8]
-                log_error(
-                    error_id=error_id2,
-                    where="openai.chat.completions.create (fallback)",
-                    exc=e2,
-                    extra={
-                        "type": "other",
-                        "model": "gpt-4o-mini",
-                        "messages_total": len(all_new_messages),
-                        "used_messages": len(new),
-                        "data_dir": DATA_DIR,
-                    },
-                )
-                return None, media_counts, error_id2
+                result = await factory()
+            except asyncio.CancelledError:
+                fut.cancel()
+                if self._stopping:
+                    raise
+                continue  # отменили саму задачу, а не воркер — он работает дальше
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(result)
+            finally:
+                openai_priority.reset(priority_token)
+                self.running[priority] -= 1
+                self.done[priority] += 1
+
+    def depth(self) -> Dict[int, int]:
+        counts: Dict[int, int] = defaultdict(int)
+        for priority, *_ in self._heap:
+            counts[priority] += 1
+        return counts
+
+    def describe(self) -> str:
+        depth = self.depth()
+        parts = []
+        for priority, name in _PRIORITY_NAMES.items():
+            done = self.done[priority]
+            avg = self.wait_total[priority] / done if done else 0.0
+            parts.append(
+                f"{name}: в очереди {depth[priority]}, выполняется {self.running[priority]}, "
+                f"выполнено {done}, ожидание avg {avg:.1f}s / max {self.wait_max[priority]:.1f}s"
+            )
+        return "; ".join(parts)
 
-        return None, media_counts, error_id
+task_queue = PriorityTaskQueue(AUTOSUMMARY_CONCURRENCY, JOB_INTERACTIVE_WORKERS)
 
 # -----------------------------------------
-# СВОДКА: отправка в чат
+# СВОДКА: аренда чата (одна сводка чата за раз)
 # -----------------------------------------
-async def _send_summary_to_chat(chat_id: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    save_history()
-    load_history()
+# Владелец аренды: хост, pid и случайная метка запуска (pid после рестарта в контейнере часто тот же)
+_LEASE_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_summary_jobs: Dict[str, "asyncio.Future[Dict[str, Any]]"] = {}
+# Сколько вызовов run_summary_job сейчас ждут каждую из сводок _summary_jobs
+_summary_waiters: Dict["asyncio.Future[Dict[str, Any]]", int] = {}
+
+def _lease_path(chat_id: str) -> str:
+    return os.path.join(LEASES_DIR, _chat_file_key(chat_id) + ".lease")
+
+def _lease_is_stale(lease: Optional[Dict[str, Any]]) -> bool:
+    if not lease or lease.get("expires", 0) <= _time.time():
+        return True
+    host, pid, run = (str(lease.get("owner", "")).split(":") + ["", "", ""])[:3]
+    if host != socket.gethostname():
+        return False  # чужой хост: верим сроку аренды
+    if pid == str(os.getpid()):
+        return run != _LEASE_OWNER.rsplit(":", 1)[1]  # наш pid, но прошлый запуск
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (OSError, ValueError):
+        return False
+    return False
+
+# Сбрасывается при первой ошибке os.link, кроме FileExistsError (том без жёстких ссылок)
+_lease_hardlinks = True
+
+def _publish_lease(tmp: str, path: str, body: str) -> None:
+    """
+    Ставит файл аренды на место, только если имени ещё нет (иначе FileExistsError).
+    Обычно ссылкой на готовый tmp — файл появляется сразу с содержимым. Где жёстких ссылок нет
+    (часть сетевых и FUSE-томов), создаём через O_CREAT|O_EXCL и дописываем: пустой файл
+    в это мгновение читатель считает занятым (см. acquire_summary_lease).
+    """
+    global _lease_hardlinks
+    if _lease_hardlinks:
+        try:
+            os.link(tmp, path)
+            return
+        except FileExistsError:
+            raise
+        except OSError as e:
+            _lease_hardlinks = False
+            print(f"Аренда: os.link не поддерживается ({e!r}), дальше создаём файл через O_EXCL")
+    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(body)
+
+def acquire_summary_lease(chat_id: str) -> bool:
+    """
+    Файл аренды появляется сразу с содержимым: тело пишется во временный файл,
+    который затем ставится на место (_publish_lease), только если имени ещё нет.
+    """
+    path = _lease_path(chat_id)
+    tmp = f"{path}.{_LEASE_OWNER.replace(':', '-')}.tmp"
+    body = json.dumps({"owner": _LEASE_OWNER, "expires": _time.time() + SUMMARY_LEASE_TTL})
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(body)
+    try:
+        for _ in range(2):
+            try:
+                _publish_lease(tmp, path, body)
+                return True
+            except FileExistsError:
+                pass
 
-    if not chat_messages.get(chat_id):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    lease = json.load(f)
+            except FileNotFoundError:
+                continue  # аренду только что сняли — пробуем ещё раз
+            except (OSError, ValueError):
+                # Нечитаемый файл (не нашего формата): считаем занятым, пока он моложе SUMMARY_LEASE_TTL
+                try:
+                    if _time.time() - os.path.getmtime(path) < SUMMARY_LEASE_TTL:
+                        return False
+                except OSError:
+                    continue
+                lease = None
+            if not _lease_is_stale(lease):
+                return False
+            print(f"Аренда сводки чата {chat_id}: снимаем протухшую ({lease})")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
         return False
+    finally:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def release_summary_lease(chat_id: str) -> None:
+    path = _lease_path(chat_id)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            if json.load(f).get("owner") != _LEASE_OWNER:
+                return
+        os.remove(path)
+    except (OSError, ValueError) as e:
+        print(f"Аренда сводки чата {chat_id}: не удалось снять:", repr(e))
+
+async def run_summary_job(
+    chat_id: str,
+    job: Callable[[], Any],
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Запускает job() под арендой чата. Возвращает (результат, attached):
+    attached=True — сводка этого чата уже шла в этом процессе, мы дождались её результата.
+    Если аренду держит другой процесс — {"status": "busy"}.
+    """
+    fut = _summary_jobs.get(chat_id)
+    if fut is not None and not fut.done():
+        print(f"Сводка чата {chat_id} уже готовится — ждём её результат")
+        return await _wait_summary_job(fut), True
+
+    async def _leased() -> Dict[str, Any]:
+        if not acquire_summary_lease(chat_id):
+            return {"status": "busy"}
+        try:
+            return await job()
+        finally:
+            release_summary_lease(chat_id)
+
+    fut = asyncio.ensure_future(_leased())
+    _summary_jobs[chat_id] = fut
+    fut.add_done_callback(lambda f: _summary_jobs.pop(chat_id) if _summary_jobs.get(chat_id) is f else None)
+    return await _wait_summary_job(fut), False
+
+async def _wait_summary_job(fut: "asyncio.Future[Dict[str, Any]]") -> Dict[str, Any]:
+    """
+    Ждёт сводку под shield: отмена одного из ждущих не отменяет её для остальных.
+    Отменили последнего ждущего (таймаут автосводки) — отменяем и саму сводку,
+    иначе она доживала бы вне лимита воркеров очереди.
+    """
+    _summary_waiters[fut] = _summary_waiters.get(fut, 0) + 1
+    try:
+        return await asyncio.shield(fut)
+    except asyncio.CancelledError:
+        if _summary_waiters[fut] == 1 and not fut.done():
+            fut.cancel()
+        raise
+    finally:
+        _summary_waiters[fut] -= 1
+        if not _summary_waiters[fut]:
+            del _summary_waiters[fut]
+
+async def _summary_job(
+    chat_id: str,
+    send: Callable[[str], Any],
+    on_start: Optional[Callable[[int], Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Сводка новых сообщений чата: модель -> last_summary_index -> отправка через send(text).
+    status: "sent", "empty" (истории нет), "few" (новых < 3), "error" (+ error_id).
+    """
+    await asyncio.to_thread(store.refresh, chat_id)
+
+    total = await asyncio.to_thread(store.count, chat_id)
+    if not total:
+        return {"status": "empty"}
 
-    messages = chat_messages[chat_id]
     last_i = last_summary_index.get(chat_id, 0)
-    all_new_messages = messages[last_i:]
+    all_new_messages = await asyncio.to_thread(store.messages_from, chat_id, last_i)
 
     if len(all_new_messages) < 3:
-        return False
+        return {"status": "few", "count": len(all_new_messages)}
+
+    if on_start is not None:
+        await on_start(len(all_new_messages))
 
-    summary, media_counts, _error_id = await _build_summary_from_new_messages(all_new_messages)
+    summary, media_counts, error_id = await _build_summary_from_new_messages(
+        all_new_messages, _valid_digest(chat_id, last_i, total)
+    )
     if not summary:
+        return {"status": "error", "error_id": error_id}
+
+    await asyncio.to_thread(store.set_summary_index, chat_id, total)
+
+    await send("📰 Сводка:\n\n" + summary + _media_summary_line(media_counts) + FOOTER_TEXT)
+    return {"status": "sent", "count": len(all_new_messages)}
+
+# -----------------------------------------
+# СВОДКА: отправка в чат
+# -----------------------------------------
+async def _send_summary_to_chat(chat_id: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    await asyncio.to_thread(store.refresh, chat_id)
+
+    # Спящие чаты отсеиваем по метаданным, не поднимая историю
+    if not await asyncio.to_thread(store.has_new_messages, chat_id, last_summary_index.get(chat_id, 0), 3):
         return False
 
-    last_summary_index[chat_id] = len(messages)
-    save_message_immediately(chat_id)
+    async def _send(text: str) -> None:
+        await context.bot.send_message(chat_id=chat_id, text=text)
 
-    final_text = "📰 Сводка:\n\n" + summary + _media_summary_line(media_counts) + FOOTER_TEXT
-    await context.bot.send_message(chat_id=chat_id, text=final_text)
-    return True
+    result, attached = await run_summary_job(chat_id, functools.partial(_summary_job, chat_id, _send))
+    return result["status"] == "sent" and not attached
 
 # -----------------------------------------
 # РУЧНАЯ СВОДКА
 # -----------------------------------------
 async def whatsnew(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Сводка идёт через очередь раньше фоновых задач (и раньше них в лимитах OpenAI).
+    # Хендлер не ждёт её: обработка остальных апдейтов не стоит, пока модель думает.
     chat_id = str(update.effective_chat.id)
+    fut = task_queue.submit(PRIORITY_INTERACTIVE, f"whatsnew {chat_id}", functools.partial(_whatsnew, update))
+    fut.add_done_callback(functools.partial(_log_job_failure, "whatsnew", chat_id))
 
-    save_history()
-    load_history()
-
-    if not chat_messages.get(chat_id):
-        await update.message.reply_text("Нет сообщений.")
+def _log_job_failure(where: str, chat_id: str, fut: "asyncio.Future") -> None:
+    if fut.cancelled() or fut.exception() is None:
         return
+    error_id = uuid.uuid4().hex[:8]
+    log_error(error_id, where, fut.exception(), {"chat_id": chat_id})
 
-    messages = chat_messages[chat_id]
-    last_i = last_summary_index.get(chat_id, 0)
-    all_new_messages = messages[last_i:]
+async def _whatsnew(update: Update) -> None:
+    chat_id = str(update.effective_chat.id)
 
-    if len(all_new_messages) < 3:
-        await update.message.reply_text(f"Новых сообщений мало ({len(all_new_messages)}).")
-        return
+    async def _reply(text: str) -> None:
+        await update.message.reply_text(text)
 
-    await update.message.reply_text(f"🤔 Анализирую {len(all_new_messages)} сообщений...")
+    async def _on_start(n: int) -> None:
+        await update.message.reply_text(f"🤔 Анализирую {n} сообщений...")
 
-    summary, media_counts, error_id = await _build_summary_from_new_messages(all_new_messages)
-    if not summary:
+    result, attached = await run_summary_job(
+        chat_id, functools.partial(_summary_job, chat_id, _reply, _on_start)
+    )
+    status = result["status"]
+
+    if status == "sent":
+        if attached:
+            await update.message.reply_text("☝️ Сводку как раз готовили по другому запросу — она выше.")
+        return
+
+    if status == "busy":
+        await update.message.reply_text("⏳ Сводка этого чата уже готовится, скоро появится.")
+    elif status == "empty":
+        await update.message.reply_text("Нет сообщений.")
+    elif status == "few":
+        await update.message.reply_text(f"Новых сообщений мало ({result['count']}).")
+    else:
+        error_id = result.get("error_id")
         if error_id and isinstance(error_id, str) and error_id.startswith("NETWORK:"):
             clean_id = error_id.split(":", 1)[1]
             msg = (
@@ -661,34 +3668,56 @@ async def whatsnew(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if error_id:
                 msg += f"\nКод ошибки: {error_id}\nЛог: {ERROR_LOG_FILE}"
         await update.message.reply_text(msg)
-        return
-
-    last_summary_index[chat_id] = len(messages)
-    save_message_immediately(chat_id)
-
-    final_text = "📰 Сводка:\n\n" + summary + _media_summary_line(media_counts) + FOOTER_TEXT
-    await update.message.reply_text(final_text)
 
 # -----------------------------------------
 # АВТОСВОДКА: 05:00 и 18:00 (UTC+3)
 # -----------------------------------------
 async def autosummary_job(context: ContextTypes.DEFAULT_TYPE):
-    load_history()
-    if not chat_messages:
+    await asyncio.to_thread(store.refresh)
+    chat_ids = await asyncio.to_thread(store.chat_ids)
+    if not chat_ids:
         return
 
-    for chat_id in list(chat_messages.keys()):
+    # Чаты идут фоновыми задачами очереди: параллельно не больше AUTOSUMMARY_CONCURRENCY,
+    # медленный чат занимает один воркер и не задерживает остальные, /whatsnew — вне очереди
+    job_started = _time.monotonic()
+
+    async def _run_chat(chat_id: str) -> Tuple[str, bool, float]:
+        started = _time.monotonic()
+        sent = False
         try:
-            await _send_summary_to_chat(chat_id, context)
+            sent = await asyncio.wait_for(
+                _send_summary_to_chat(chat_id, context),
+                timeout=AUTOSUMMARY_CHAT_TIMEOUT,
+            )
         except Exception as e:
             error_id = uuid.uuid4().hex[:8]
             log_error(error_id, "autosummary_job loop", e, {"chat_id": chat_id})
+        elapsed = _time.monotonic() - started
+        print(f"autosummary: chat={chat_id} sent={sent} time={elapsed:.1f}s")
+        return chat_id, sent, elapsed
+
+    results = await asyncio.gather(
+        *(
+            task_queue.submit(PRIORITY_BATCH, f"autosummary {chat_id}", functools.partial(_run_chat, chat_id))
+            for chat_id in chat_ids
+        )
+    )
+
+    sent_total = sum(1 for _, sent, _ in results if sent)
+    slowest_chat, _, slowest_time = max(results, key=lambda r: r[2])
+    print(
+        f"autosummary: отправлено {sent_total}/{len(results)} сводок "
+        f"за {_time.monotonic() - job_started:.1f}s "
+        f"(параллельно {AUTOSUMMARY_CONCURRENCY}, самый долгий чат {slowest_chat}: {slowest_time:.1f}s)"
+    )
+    print(f"Очередь: {task_queue.describe()}")
 
 # -----------------------------------------
 # АВТОСТАТИСТИКА: 1-го числа 05:05 (UTC+3) + дедуп
 # -----------------------------------------
 async def monthly_stats_job(context: ContextTypes.DEFAULT_TYPE):
-    load_history()
+    await asyncio.to_thread(store.refresh)
 
     now = _now_tz()
     if now.day != 1:
@@ -699,24 +3728,30 @@ async def monthly_stats_job(context: ContextTypes.DEFAULT_TYPE):
     prev_month_start, _ = _month_range_for(prev_month_end - timedelta(seconds=1))
     prev_month_key = prev_month_start.strftime("%Y-%m")
 
-    for chat_id, messages in list(chat_messages.items()):
+    async def _send_chat_stats(chat_id: str) -> None:
         try:
-            if monthly_stats_last_sent.get(chat_id) == prev_month_key:
-                continue
-
             last_i = last_summary_index.get(chat_id, 0)
-            text = _format_stats_for_period(messages, last_i, prev_month_start, prev_month_end)
+            period_stats = await asyncio.to_thread(store.period_stats, chat_id, last_i, prev_month_start, prev_month_end)
+            text = _format_stats_for_period(period_stats, prev_month_start, prev_month_end)
             text = "🗓 Ежемесячная статистика\n\n" + text
 
             await context.bot.send_message(chat_id=chat_id, text=text)
 
             monthly_stats_last_sent[chat_id] = prev_month_key
-            save_monthly_stats_sent()
+            await asyncio.to_thread(store.save_monthly_stats_sent)
 
         except Exception as e:
             error_id = uuid.uuid4().hex[:8]
             log_error(error_id, "monthly_stats_job loop", e, {"chat_id": chat_id, "prev_month_key": prev_month_key})
 
+    await asyncio.gather(
+        *(
+            task_queue.submit(PRIORITY_BATCH, f"monthly_stats {chat_id}", functools.partial(_send_chat_stats, chat_id))
+            for chat_id in await asyncio.to_thread(store.chat_ids)
+            if monthly_stats_last_sent.get(chat_id) != prev_month_key
+        )
+    )
+
 # -----------------------------------------
 # /NETCHECK: диагностика сети из Telegram
 # -----------------------------------------
@@ -777,6 +3812,11 @@ async def netcheck(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lines.append("🔒 TLS probes:")
     lines.append(f"  api.openai.com:443 → {_tls_probe('api.openai.com', 443)}")
 
+    lines.append("")
+    lines.append(f"⚡ Предохранитель OpenAI: {openai_breaker.describe()}")
+    lines.append(f"🚦 Лимиты OpenAI: {openai_limiter.describe()}")
+    lines.append(f"📋 Очередь задач: {task_queue.describe()}")
+
     http_proxy = os.getenv("HTTP_PROXY") or os.getenv("http_proxy")
     https_proxy = os.getenv("HTTPS_PROXY") or os.getenv("https_proxy")
     if http_proxy or https_proxy:
@@ -796,6 +3836,24 @@ async def netcheck(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------------------------
 # MAIN
 # -----------------------------------------
+# Фоновая загрузка кодировки tiktoken (warm_token_counter): старт бота её не ждёт
+_token_counter_warmup: Optional[asyncio.Task] = None
+
+async def _on_startup(app) -> None:
+    global _token_counter_warmup
+    write_buffer.start()
+    task_queue.start()
+    _token_counter_warmup = asyncio.get_running_loop().create_task(asyncio.to_thread(warm_token_counter))
+
+async def _on_shutdown(app) -> None:
+    if _token_counter_warmup is not None and not _token_counter_warmup.done():
+        _token_counter_warmup.cancel()
+    await task_queue.stop()
+    await openai_breaker.stop()
+    await write_buffer.stop()
+    await asyncio.to_thread(store.close)
+    await client.close()
+
 def main():
     print("=== ЗАПУСК БОТА ===")
 
@@ -807,14 +3865,34 @@ def main():
         return
 
     print(f"DATA_DIR: {DATA_DIR}")
-    print(f"HISTORY_FILE: {HISTORY_FILE}")
+    print(f"STORAGE_BACKEND: {store.name}")
+    print(f"CHATS_DIR: {CHATS_DIR} (journal fsync={JOURNAL_FSYNC}, снапшот каждые {SNAPSHOT_INTERVAL}s)")
+    print(f"RESIDENT_MAX_MESSAGES: {RESIDENT_MAX_MESSAGES}")
+    print(
+        f"RETENTION: {RETENTION_ENABLED} (в сводке: держим {RETENTION_KEEP_MESSAGES} сообщений "
+        f"и всё моложе {RETENTION_KEEP_DAYS} дней)"
+    )
+    print(f"WRITE_BEHIND: {WRITE_BEHIND_MAX_DELAY_MS}ms / {WRITE_BEHIND_MAX_PENDING} записей, до {WRITE_BEHIND_MAX_RETRIES} попыток сброса")
     print(f"ERROR_LOG_FILE: {ERROR_LOG_FILE}")
     print(f"MAX_MESSAGES_FOR_ANALYSIS: {MAX_MESSAGES_FOR_ANALYSIS}")
     print(f"MAX_TEXT_LENGTH_PER_MESSAGE: {MAX_TEXT_LENGTH_PER_MESSAGE}")
-
-    load_history()
-
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    print(f"TOKENIZER: {TOKEN_COUNTER_NAME} | SUMMARY_PROMPT_TOKEN_BUDGET: {SUMMARY_PROMPT_TOKEN_BUDGET}")
+    print(f"OPENAI_TIMEOUT: {OPENAI_TIMEOUT}s | OPENAI_MAX_CONNECTIONS: {OPENAI_MAX_CONNECTIONS}")
+    print(f"OPENAI_RETRY: до {OPENAI_RETRY_MAX_ATTEMPTS} попыток | SUMMARY_DEADLINE: {SUMMARY_DEADLINE}s")
+    print(f"OPENAI_RPM: {OPENAI_RPM} | OPENAI_TPM: {OPENAI_TPM}")
+    print(f"OPENAI_BREAKER: {OPENAI_BREAKER_THRESHOLD} ошибок соединения/5xx подряд, проба каждые {OPENAI_BREAKER_COOLDOWN}s")
+    print(f"AUTOSUMMARY_CONCURRENCY: {AUTOSUMMARY_CONCURRENCY} | JOB_INTERACTIVE_WORKERS: {JOB_INTERACTIVE_WORKERS}")
+    print(f"ROLLING_DIGEST: {ROLLING_DIGEST_ENABLED} (каждые {ROLLING_DIGEST_EVERY} сообщений)")
+
+    store.load()
+
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(_on_startup)
+        .post_shutdown(_on_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("stats", stats))
@@ -844,6 +3922,32 @@ def main():
         name="autosummary_1800",
     )
 
+    # Скользящий конспект (фон)
+    if ROLLING_DIGEST_ENABLED:
+        app.job_queue.run_repeating(
+            rolling_digest_job,
+            interval=ROLLING_DIGEST_INTERVAL,
+            first=ROLLING_DIGEST_INTERVAL,
+            name="rolling_digest",
+        )
+
+    # Снапшоты журналов (фон)
+    app.job_queue.run_repeating(
+        snapshot_job,
+        interval=SNAPSHOT_INTERVAL,
+        first=SNAPSHOT_INTERVAL,
+        name="snapshot",
+    )
+
+    # Политика хранения (фон)
+    if RETENTION_ENABLED:
+        app.job_queue.run_repeating(
+            retention_job,
+            interval=RETENTION_INTERVAL,
+            first=300,
+            name="retention",
+        )
+
     # Автостатистика: 05:05 UTC+3 (проверяем, что сегодня 1-е число)
     app.job_queue.run_daily(
         monthly_stats_job,
@@ -0,0 +1,223 @@
+"""
+Хранилище истории: восстановление после падения, снапшоты, политика хранения, аренда сводок.
+
+main читает настройки из окружения при импорте и держит состояние в глобальных переменных,
+поэтому каждый "запуск бота" — отдельный процесс со своим DATA_DIR.
+Падение — os._exit без остановки бота (без финального сброса и снапшота).
+
+Запуск из корня репозитория:
+    python -m unittest discover -s tests
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def bot_command(code: str) -> list:
+    """
+    Команда процесса, который импортирует main и выполняет code. out(...) печатает результат.
+    """
+    script = (
+        f"import json, os, sys\n"
+        f"sys.path.insert(0, {ROOT!r})\n"
+        f"import main\n"
+        f"result = {{}}\n"
+        f"def out(**kw):\n"
+        f"    result.update(kw)\n"
+        f"    print('RESULT ' + json.dumps(result), flush=True)\n"
+        + textwrap.dedent(code)
+    )
+    return [sys.executable, "-c", script]
+
+def bot_env(data_dir: str, **env: str) -> dict:
+    return dict(
+        os.environ,
+        DATA_DIR=data_dir,
+        OPENAI_API_KEY="test",
+        WRITE_BEHIND_MAX_DELAY_MS="0",
+        TOKENIZER="heuristic",
+        **env,
+    )
+
+def parse_result(stdout: str) -> dict:
+    results = [line for line in stdout.splitlines() if line.startswith("RESULT ")]
+    return json.loads(results[-1][len("RESULT "):]) if results else {}
+
+def run_bot(data_dir: str, code: str, **env: str) -> dict:
+    """
+    Выполняет code в новом процессе с импортированным main. Результат — JSON из out(...).
+    """
+    proc = subprocess.run(bot_command(code), env=bot_env(data_dir, **env), capture_output=True, text=True, timeout=120)
+    if proc.returncode != 0:
+        raise AssertionError(f"процесс упал ({proc.returncode}):\n{proc.stdout}\n{proc.stderr}")
+    return parse_result(proc.stdout)
+
+APPEND = """
+def append(chat_id, n, ts, start=0, user="alice"):
+    for i in range(start, start + n):
+        main.store.append(chat_id, {"username": user, "user_id": 1, "text": f"msg {i}", "ts": ts + i, "type": "text"})
+"""
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory(prefix="ca_cat_bot_test_")
+        self.data_dir = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+class JournalReplayTest(StorageTestCase):
+    def test_messages_survive_crash_without_snapshot(self):
+        for backend in ("json", "sqlite"):
+            with self.subTest(backend=backend):
+                data_dir = os.path.join(self.data_dir, backend)
+                run_bot(data_dir, APPEND + """
+main.store.load()
+append("-100", 25, 1_700_000_000)
+os._exit(0)
+""", STORAGE_BACKEND=backend)
+
+                result = run_bot(data_dir, """
+main.store.load()
+msgs = main.store.messages_from("-100", 0)
+out(count=main.store.count("-100"), first=msgs[0]["text"], last=msgs[-1]["text"])
+""", STORAGE_BACKEND=backend)
+                self.assertEqual(result, {"count": 25, "first": "msg 0", "last": "msg 24"})
+
+    def test_journal_tail_is_replayed_on_top_of_snapshot(self):
+        run_bot(self.data_dir, APPEND + """
+main.store.load()
+append("-100", 10, 1_700_000_000)
+main.store.snapshot()
+append("-100", 5, 1_700_000_000, start=10)
+os._exit(0)
+""")
+        result = run_bot(self.data_dir, """
+main.store.load()
+cols = main.chat_messages["-100"]
+out(base=cols.base, end=cols.end, texts=[m["text"] for m in cols.rows(0)][-6:])
+""")
+        self.assertEqual(result["end"], 15)
+        self.assertEqual(result["base"], 0)
+        self.assertEqual(result["texts"], [f"msg {i}" for i in range(9, 15)])
+
+class SnapshotFallbackTest(StorageTestCase):
+    def test_corrupt_snapshot_falls_back_to_prev(self):
+        result = run_bot(self.data_dir, """
+path = os.path.join(main.DATA_DIR, "state.json")
+main.write_snapshot_file(path, {"version": 1})
+main.write_snapshot_file(path, {"version": 2})
+with open(path, "r+b") as f:
+    f.seek(-3, os.SEEK_END)
+    f.write(b"XXX")
+out(value=main.read_snapshot_file(path))
+""")
+        self.assertEqual(result["value"], {"version": 1})
+
+    def test_chat_loads_from_prev_when_crash_left_journal(self):
+        # Упали между снапшотом и обнулением журнала: основной снапшот битый,
+        # *.prev + журнал дают полную историю
+        run_bot(self.data_dir, APPEND + """
+main.store.load()
+append("-100", 10, 1_700_000_000)
+main.save_chat("-100")
+append("-100", 4, 1_700_000_000, start=10)
+path = main._chat_snapshot_path("-100")
+main._write_chat_snapshot("-100", main.chat_messages["-100"])
+with open(path, "r+b") as f:
+    f.seek(-3, os.SEEK_END)
+    f.write(b"XXX")
+os._exit(0)
+""")
+        result = run_bot(self.data_dir, """
+main.store.load()
+cols = main.chat_messages["-100"]
+out(end=cols.end, last=cols.text(len(cols) - 1))
+""")
+        self.assertEqual(result, {"end": 14, "last": "msg 13"})
+
+class RetentionTest(StorageTestCase):
+    def test_monthly_stats_keep_dropped_messages_across_restart(self):
+        env = {"RETENTION_KEEP_DAYS": "1", "RETENTION_KEEP_MESSAGES": "5"}
+        for backend in ("json", "sqlite"):
+            with self.subTest(backend=backend):
+                data_dir = os.path.join(self.data_dir, backend)
+                before = run_bot(data_dir, APPEND + """
+from datetime import datetime
+main.store.load()
+ts = int(datetime(2024, 3, 10, 12, tzinfo=main.BOT_TZ).timestamp())
+append("-100", 30, ts, user="alice")
+append("-100", 20, ts, start=30, user="bob")
+main.store.set_summary_index("-100", 50)
+dropped = main.store.compact("-100", ts + 400 * 86400)
+start, end = main._month_range_for(datetime.fromtimestamp(ts, main.BOT_TZ))
+out(dropped=dropped, stats=main.store.period_stats("-100", 50, start, end))
+main.store.snapshot()
+main.store.close()
+""", STORAGE_BACKEND=backend, **env)
+                self.assertEqual(before["dropped"], 45)
+
+                after = run_bot(data_dir, """
+from datetime import datetime
+main.store.load()
+start, end = main._month_range_for(datetime(2024, 3, 15, tzinfo=main.BOT_TZ))
+out(count=main.store.count("-100"), stats=main.store.period_stats("-100", 50, start, end))
+""", STORAGE_BACKEND=backend, **env)
+                self.assertEqual(after["count"], 50)
+                self.assertEqual(after["stats"], before["stats"])
+                self.assertEqual(after["stats"]["total"], 50)
+
+class SummaryLeaseTest(StorageTestCase):
+    def test_only_one_process_gets_the_lease(self):
+        # Все процессы стартуют заранее и берут аренду в один момент START_AT.
+        # Победитель живёт, пока пробуют остальные: аренду умершего процесса забрать можно
+        code = """
+import time
+while time.time() < float(os.environ["START_AT"]):
+    time.sleep(0.001)
+out(acquired=main.acquire_summary_lease("-100"))
+time.sleep(2)
+os._exit(0)
+"""
+        env = bot_env(self.data_dir, START_AT=str(time.time() + 3))
+        procs = [
+            subprocess.Popen(bot_command(code), env=env, stdout=subprocess.PIPE, text=True)
+            for _ in range(6)
+        ]
+        acquired = [parse_result(proc.communicate(timeout=120)[0])["acquired"] for proc in procs]
+        self.assertEqual(acquired.count(True), 1)
+
+    def test_lease_of_crashed_process_is_taken_over(self):
+        crashed = run_bot(self.data_dir, """
+out(acquired=main.acquire_summary_lease("-100"))
+os._exit(0)
+""")
+        self.assertTrue(crashed["acquired"])
+
+        # Тот же хост, процесса-владельца больше нет — аренду можно не ждать
+        taken = run_bot(self.data_dir, """
+out(acquired=main.acquire_summary_lease("-100"))
+main.release_summary_lease("-100")
+out(left=os.path.exists(main._lease_path("-100")))
+""")
+        self.assertEqual(taken, {"acquired": True, "left": False})
+
+    def test_lease_of_other_host_is_kept_until_expiry(self):
+        result = run_bot(self.data_dir, """
+import time
+with open(main._lease_path("-100"), "w", encoding="utf-8") as f:
+    json.dump({"owner": "other-host:1:feedface", "expires": time.time() + 1}, f)
+out(while_valid=main.acquire_summary_lease("-100"))
+time.sleep(1.2)
+out(after_expiry=main.acquire_summary_lease("-100"))
+""")
+        self.assertEqual(result, {"while_valid": False, "after_expiry": True})
+
+if __name__ == "__main__":
+    unittest.main()